@@ -1,7 +1,7 @@
 #! /usr/bin/env python3
 # -*- coding: utf-8 -*-
 # Relays news entries to the announce mailing list.
-# To be run with minimal privileges shortly after every full hour.
+# To be run with minimal privileges every minute or as daemon (--daemon).
 
 # Initial version, 10/2010:
 #     B. Hof <hof@stusta.net>
@@ -17,105 +17,369 @@
 # Added nextcloud calendar integration
 #     T. Jülg <tj@stusta.de>
 
-import configparser
+import hashlib
+import html
 import smtplib
+import sqlite3
 import sys
+import time
 import os
 import re
 import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from email.utils import make_msgid, formatdate, formataddr
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 
-import caldav
-import mwclient
-import pytz
-from bs4 import BeautifulSoup
-from ics import Event, Calendar
+import wikibot
 
 
-def event2cal(calendar):
-    config = configparser.RawConfigParser()
-    config.read(os.path.dirname(os.path.realpath(__file__)) + '/announce.ini')
-    cfg = config.get
+SMTP_HOST = 'mail.stusta.de'
 
-    url = cfg('cal_dav', 'dav_url')
-    username = cfg('cal_dav', 'dav_user')
-    password = cfg('cal_dav', 'dav_password')
-    client = caldav.DAVClient(url=url, username=username, password=password)
-    stustanet_calendar = client.calendar(url=cfg('cal_dav', 'calendar_url'))
-    stustanet_calendar.save_event(str(calendar))
+# format of the Datum field returned by cargoquery
+DATUM_FORMAT = '%Y-%m-%d %H:%M:%S'
+# cargoquery of the news entries
+NEWS_QUERY = {
+    'tables': 'News',
+    'fields': '_pageName=Page,Titel,Autor,Zusammenfassung,Datum',
+    'order_by': 'Datum ASC',
+    'format': 'json',
+}
+NEWS_CONDITION = 'Infoseite=1 AND Kategorie="StuStaNet"'
 
 
-def format_news(entry, page):
-    content = page.text()
-    content = content.replace("{{!}}", "")
-    content = content.split("\n}}\n")
+class Ledger:
+    """Ledger records the announced pages in a SQLite database
+
+    The newest announced Datum is the cursor from which the next run continues.
+    Targets (mail, calendar) of partially announced pages are recorded, so they are not repeated.
+    """
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.db = sqlite3.connect(path)
+        with self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS announced '
+                            '(page TEXT PRIMARY KEY, datum TEXT NOT NULL, announced_at TEXT NOT NULL)')
+            self.db.execute('CREATE TABLE IF NOT EXISTS sent (page TEXT NOT NULL, target TEXT NOT NULL, '
+                            'PRIMARY KEY (page, target))')
+
+    def close(self):
+        self.db.close()
+
+    def cursor(self):
+        """returns the Datum of the newest announced entry, None if nothing was announced yet"""
+        return self.db.execute('SELECT MAX(datum) FROM announced').fetchone()[0]
+
+    def announced(self, page):
+        return self.db.execute('SELECT 1 FROM announced WHERE page=?', (page,)).fetchone() is not None
+
+    def sent(self, page, target):
+        return self.db.execute('SELECT 1 FROM sent WHERE page=? AND target=?', (page, target)).fetchone() is not None
+
+    def add_sent(self, page, target):
+        with self.db:
+            self.db.execute('INSERT OR IGNORE INTO sent VALUES (?, ?)', (page, target))
+
+    def add(self, page, datum):
+        with self.db:
+            self.db.execute('INSERT OR REPLACE INTO announced VALUES (?, ?, ?)',
+                            (page, datum, datetime.now().strftime(DATUM_FORMAT)))
+            self.db.execute('DELETE FROM sent WHERE page=?', (page,))
+
+
+def smtp_permanent(ex):
+    """returns whether ex is a permanent (5xx) rejection of a mail, sending it again would fail as well"""
+    if isinstance(ex, smtplib.SMTPRecipientsRefused):
+        return all(code >= 500 for code, _ in ex.recipients.values())
+    return isinstance(ex, smtplib.SMTPResponseException) and ex.smtp_code >= 500
+
+
+class AnnounceSession:
+    """AnnounceSession keeps one SMTP connection and one CalDAV calendar for all announcements of a run
+
+    Both are opened on first use and reopened up to retries times if a connection error occurs.
+    Mails and calendar events are sent by one thread each, so a slow server only delays its own target.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.smtp = None
+        self.dav_client = None
+        self.calendar = None
+        self.retries = config.getint('announce', 'retries', fallback=2)
+        self.smtp_timeout = config.getint('announce', 'smtp_timeout', fallback=30)
+        self.dav_timeout = config.getint('announce', 'dav_timeout', fallback=30)
+        # one lane per target: the SMTP connection and the CalDAV client are only used by their own thread
+        self.mail_lane = ThreadPoolExecutor(max_workers=1, thread_name_prefix='mail')
+        self.calendar_lane = ThreadPoolExecutor(max_workers=1, thread_name_prefix='calendar')
+        self.mail_failed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.mail_lane.submit(self.close_smtp)
+        self.calendar_lane.submit(self.close_calendar)
+        self.mail_lane.shutdown()
+        self.calendar_lane.shutdown()
+
+    def close_smtp(self):
+        if self.smtp is not None:
+            try:
+                self.smtp.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+            self.smtp = None
+
+    def close_calendar(self):
+        if self.dav_client is not None:
+            self.dav_client.close()
+            self.dav_client = None
+            self.calendar = None
+
+    def retry(self, attempt, close):
+        """closes the connection and waits before the next attempt, returns False if there is none"""
+        close()
+        if attempt >= self.retries:
+            return False
+        time.sleep(attempt + 1)
+        return True
+
+    def sendmail(self, from_addr, to_addr, msg):
+        for attempt in range(self.retries + 1):
+            try:
+                if self.smtp is None:
+                    self.smtp = smtplib.SMTP(SMTP_HOST, timeout=self.smtp_timeout)
+                self.smtp.sendmail(from_addr, to_addr, msg)
+                return
+            except OSError as ex:
+                # e.g. the server closed the connection in the meantime or is busy (4xx), but not if it
+                # rejected the mail for good
+                if smtp_permanent(ex) or not self.retry(attempt, self.close_smtp):
+                    raise
+
+    def save_event(self, ical):
+        cfg = self.config.get
+        caldav = wikibot.lazy_import('caldav')
+        for attempt in range(self.retries + 1):
+            try:
+                if self.calendar is None:
+                    self.dav_client = caldav.DAVClient(url=cfg('cal_dav', 'dav_url'),
+                                                       username=cfg('cal_dav', 'dav_user'),
+                                                       password=cfg('cal_dav', 'dav_password'),
+                                                       timeout=self.dav_timeout)
+                    self.calendar = self.dav_client.calendar(url=cfg('cal_dav', 'calendar_url'))
+                self.calendar.save_event(ical)
+                return
+            except (caldav.lib.error.DAVError, OSError):
+                if not self.retry(attempt, self.close_calendar):
+                    raise
+
+    def submit_mail(self, func, *args):
+        """queues func(self, *args) for the mail lane
+
+        Mails are sent in the order they were submitted. After a mail failed for a transient reason, the following
+        ones are skipped, so the next run sends them in order. A permanently rejected mail does not stop the others.
+        """
+        def send():
+            if self.mail_failed:
+                raise RuntimeError('skipped after a failed mail')
+            try:
+                func(self, *args)
+            except Exception as ex:
+                if not smtp_permanent(ex):
+                    self.mail_failed = True
+                raise
+        return self.mail_lane.submit(send)
+
+    def submit_event(self, func, *args):
+        """queues func(self, *args) for the calendar lane"""
+        return self.calendar_lane.submit(func, self, *args)
+
+
+def event2cal(session, calendar):
+    session.save_event(str(calendar))
+
+
+# maximum number of titles per API query
+TITLES_PER_QUERY = 50
+
+
+def fetch_texts(site, titles):
+    """returns {title: wikitext} of the current revisions of titles, fetched with as few queries as possible"""
+    titles = list(dict.fromkeys(titles))
+    texts = {}
+    for i in range(0, len(titles), TITLES_PER_QUERY):
+        chunk = titles[i:i + TITLES_PER_QUERY]
+        normalized = {}
+        params = {}
+        while True:
+            result = site.get('query', prop='revisions', rvprop='content', rvslots='main', formatversion=2,
+                              titles='|'.join(chunk), **params)
+            query = result.get('query', {})
+            for norm in query.get('normalized', []):
+                normalized[norm['to']] = norm['from']
+            for page in query.get('pages', []):
+                revisions = page.get('revisions')
+                if revisions:
+                    title = normalized.get(page['title'], page['title'])
+                    texts[title] = revisions[0]['slots']['main']['content']
+            # large contents are split over several responses
+            if 'continue' not in result:
+                break
+            params = result['continue']
+    return texts
+
+
+# tokens of parse_wikitext: {{!}}, template and link brackets, parameter separators, html comments and tags, newlines
+WIKITEXT_TOKENS = re.compile(r'\{\{!\}\}|\{\{|\}\}|\[\[|\]\]|\||<!--.*?(?:-->|$)|</?[A-Za-z][^<>]*>|\n', re.DOTALL)
+CLOSING = {'}}': '{{', ']]': '[['}
+
+
+def template_name(name):
+    name = name.strip().replace('_', ' ')
+    return name[:1].upper() + name[1:]
+
+
+def template_source(parts):
+    return '|'.join(''.join(part) for part in parts)
 
-    text = ""
-    body = ""
-    for item in content:
-        if item.startswith("{{StuStaNet-News"):
-            continue
-        if item.startswith("{{Termin"):
-            start = ""
-            end = ""
-            location = ""
-            lines = item.splitlines()
-            for line in lines:
-                if line.startswith("|von="):
-                    start = line[5:]
-                elif line.startswith("|bis="):
-                    end = line[5:]
-                elif line.startswith("|Ort="):
-                    location = line[5:]
-            if start != "":
-                body += "Datum: " + start
-                if end != "":
-                    body += " bis " + end
-                body += "\n"
-            if location != "":
-                body += "Ort: " + location + "\n"
 
+def make_template(parts):
+    """returns the name and the {parameter: value} of a template from its parts between the separators"""
+    parts = [''.join(part) for part in parts]
+    params = {}
+    for i, part in enumerate(parts[1:], 1):
+        if '=' in part:
+            key, value = part.split('=', 1)
+            params[key.strip()] = html.unescape(value.strip())
         else:
-            text += item + "\n"
+            params[str(i)] = html.unescape(part.strip())
+    return template_name(parts[0]), params
 
-    calendar = None
+
+def parse_wikitext(wikitext, extract):
+    """tokenizes wikitext in a single pass
+
+    Returns {name: parameters} of the first top-level template of every name in extract and the remaining text.
+    Other templates stay in the text. Html tags and comments are removed and {{!}} is dropped, as before.
+    """
+    templates = {}
+    text = []
+    # open template/link brackets
+    stack = []
+    # parts of the current top-level template, None outside of templates
+    parts = None
+    pos = 0
+    for match in WIKITEXT_TOKENS.finditer(wikitext):
+        out = parts[-1] if parts is not None else text
+        out.append(wikitext[pos:match.start()])
+        pos = match.end()
+        mark = match.group()
+        if mark == '{{!}}' or mark[0] == '<':
+            continue
+        if mark == '\n':
+            out.append(mark)
+            # links end at the line, an unclosed [[ is plain text and must not hide the following templates
+            stack = [bracket for bracket in stack if bracket != '[[']
+            continue
+        if mark in ('{{', '[['):
+            if not stack and mark == '{{':
+                parts = [[]]
+            else:
+                out.append(mark)
+            stack.append(mark)
+        elif mark in CLOSING:
+            if not stack or stack[-1] != CLOSING[mark]:
+                # unbalanced, keep it as text
+                out.append(mark)
+                continue
+            stack.pop()
+            if stack or parts is None:
+                out.append(mark)
+                continue
+            name, params = make_template(parts)
+            if name in extract:
+                templates.setdefault(name, params)
+            else:
+                text.append('{{' + template_source(parts) + '}}')
+            parts = None
+        elif parts is not None and len(stack) == 1:
+            parts.append([])
+        else:
+            out.append(mark)
+    (parts[-1] if parts is not None else text).append(wikitext[pos:])
+    if parts is not None:
+        # unclosed template
+        text.append('{{' + template_source(parts))
+    return templates, html.unescape(''.join(text))
+
+
+def make_event(entry, templates, start, end, location):
+    """returns a calendar with the event of the news entry, None for news without a (valid) date"""
+    if start == "":
+        return None
     try:
-        tz = pytz.timezone('Europe/Berlin')
-        starttime = tz.localize(datetime.strptime(start, "%Y/%m/%d %H:%M:%S"))
-        event = Event()
-        event.name = entry['Titel']
-        event.begin = starttime
-        try:
-            endtime = tz.localize(datetime.strptime(end, "%Y/%m/%d %H:%M:%S"))
-        except ValueError:
-            # default to 2 hours duration
-            endtime = starttime + timedelta(hours=2)
-        event.end = endtime
-        if location != "":
-            event.location = location
-        tmp = page.text()
-        ms = [re.search(r"\|Zusammenfassung=(.*)", line)
-              for line in tmp.split('\n')]
-        ms = [m for m in ms if m is not None]
-        if len(ms) > 0:
-            event.description = ms[0].groups()[0]
-
-        calendar = Calendar()
-        calendar.events.add(event)
+        starttime = datetime.strptime(start, "%Y/%m/%d %H:%M:%S")
     except ValueError:
         print(f"Value error: couldn't parse date {start}")
-        calendar = None
+        return None
+    try:
+        endtime = datetime.strptime(end, "%Y/%m/%d %H:%M:%S")
+    except ValueError:
+        # default to 2 hours duration
+        endtime = starttime + timedelta(hours=2)
+
+    # only imported for news with a date
+    pytz = wikibot.lazy_import('pytz')
+    ics = wikibot.lazy_import('ics')
+    tz = pytz.timezone('Europe/Berlin')
+    event = ics.Event()
+    # a stable uid, so saving the event again replaces it
+    event.uid = hashlib.sha256(entry['Page'].encode('utf-8')).hexdigest() + '@wiki.stusta.de'
+    event.name = entry['Titel']
+    event.begin = tz.localize(starttime)
+    event.end = tz.localize(endtime)
+    if location != "":
+        event.location = location
+    summary = templates.get('StuStaNet-News', {}).get('Zusammenfassung')
+    summary = summary or templates.get('Termin', {}).get('Zusammenfassung')
+    if summary:
+        event.description = summary
+
+    calendar = ics.Calendar()
+    calendar.events.add(event)
+    return calendar
+
+
+def format_news(entry, wikitext):
+    templates, text = parse_wikitext(wikitext, ('StuStaNet-News', 'Termin'))
+    termin = templates.get('Termin', {})
+    start = termin.get('von', '')
+    end = termin.get('bis', '')
+    location = termin.get('Ort', '')
+
+    body = ""
+    if start != "":
+        body += "Datum: " + start
+        if end != "":
+            body += " bis " + end
+        body += "\n"
+    if location != "":
+        body += "Ort: " + location + "\n"
+
+    calendar = make_event(entry, templates, start, end, location)
 
     body += "Zusammenfassung:\n"
     body += entry['Zusammenfassung']
     body += "\n\n\n"
 
-    text = ''.join(BeautifulSoup(
-        text, "html.parser").findAll(text=True)).strip()
-    body += text
+    body += text.strip()
 
     body += "\n\n\n"
     body += "Quelle: https://wiki.stusta.de/" + \
@@ -132,7 +396,7 @@ def attach_calendar(msg, calendar):
 
 
 # send mail to announce list
-def send_mail(subject, author, body, calendar=None):
+def send_mail(session, subject, author, body, calendar=None):
     print("Sending Announce Email:", subject)
     from_addr = "no-reply@stusta.mhn.de"
     from_domain = from_addr.split('@')[1]
@@ -152,37 +416,187 @@ def send_mail(subject, author, body, calendar=None):
     if calendar:
         attach_calendar(msg, calendar)
 
-    smtp = smtplib.SMTP('mail.stusta.de')
-    smtp.sendmail(from_addr, to_addr, msg.as_string())
-    smtp.quit()
+    session.sendmail(from_addr, to_addr, msg.as_string())
+
+
+def news_where(cursor, lookback, lead):
+    """returns the cargoquery condition for the news entries to announce
 
+    Entries up to lead minutes in the future are announced. Entries are looked up from lookback minutes before cursor,
+    so entries which were added or moved late are not missed.
+    """
+    where = NEWS_CONDITION + f' AND TIMESTAMPDIFF(MINUTE,NOW(),Datum)<={lead:d}'
+    if cursor is None:
+        # nothing announced yet: only the last hour, do not flood the list with old news
+        return where + ' AND TIMESTAMPDIFF(MINUTE,NOW(),Datum)>-55'
+    since = datetime.strptime(cursor, DATUM_FORMAT) - timedelta(minutes=lookback)
+    return where + f' AND Datum>"{since.strftime(DATUM_FORMAT)}"'
 
-def main():
-    site = mwclient.Site('wiki.stusta.de', path='/')
 
-    # get stustanet news which should be announce between 55 minutes ago and in 5 minutes
-    # If the script is run every hour, every announce is sent exactly once
-    results = site.get('cargoquery',
-                       tables='News',
-                       fields='_pageName=Page,Titel,Autor,Zusammenfassung,Datum',
-                       where='Infoseite=1 AND Kategorie="StuStaNet"'
-                             'AND TIMESTAMPDIFF(MINUTE,NOW(),Datum)<=5 AND TIMESTAMPDIFF(MINUTE,NOW(),Datum)>-55',
-                       order_by='Datum ASC',
-                       format='json',
-                       )
+def announce(config, site, ledger):
+    """announces all due news entries which were not announced yet"""
+    lookback = config.getint('announce', 'lookback', fallback=1440)
+    lead = config.getint('announce', 'lead', fallback=5)
 
+    # get stustanet news which are due and were not announced yet
+    results = site.get('cargoquery', where=news_where(ledger.cursor(), lookback, lead), **NEWS_QUERY)
+
+    entries = [res['title'] for res in results['cargoquery']]
+    entries = [entry for entry in entries if not ledger.announced(entry['Page'])]
+    texts = fetch_texts(site, [entry['Page'] for entry in entries])
+
+    # mails and events are sent in the background while the next entries are formatted
+    jobs = []
+    with AnnounceSession(config) as session:
+        for entry in entries:
+            page = entry['Page']
+            author = entry['Autor']
+            if author == "":
+                author = "Infoseite"
+            subject = entry['Titel']
+            body, calendar = format_news(entry, texts.get(page, ''))
+            targets = {}
+            # create event in stustanet calendar
+            if calendar and not ledger.sent(page, 'calendar'):
+                targets['calendar'] = session.submit_event(event2cal, calendar)
+            # send mails to announce
+            if not ledger.sent(page, 'mail'):
+                targets['mail'] = session.submit_mail(send_mail, subject, author, body, calendar)
+            jobs.append((entry, targets))
+
+        # the ledger is only used by this thread
+        errors = []
+        for entry, targets in jobs:
+            failed = False
+            for target, future in targets.items():
+                try:
+                    future.result()
+                    ledger.add_sent(entry['Page'], target)
+                except Exception as ex:
+                    errors.append(ex)
+                    if target == 'mail' and smtp_permanent(ex):
+                        # sending it again would block all later mails forever
+                        print(f"Mail for {entry['Page']} rejected, not sent again: {ex}", file=sys.stderr)
+                        ledger.add_sent(entry['Page'], target)
+                        continue
+                    print(f"Failed to announce {entry['Page']} ({target}): {ex}", file=sys.stderr)
+                    failed = True
+            if not failed:
+                ledger.add(entry['Page'], entry['Datum'])
+    if errors:
+        raise errors[0]
+
+
+def next_due(config, site):
+    """returns the seconds until the next news entry is due, None if there is none"""
+    lead = config.getint('announce', 'lead', fallback=5)
+    results = site.get('cargoquery', tables='News', fields='TIMESTAMPDIFF(SECOND,NOW(),Datum)=Due',
+                       where=NEWS_CONDITION + f' AND TIMESTAMPDIFF(MINUTE,NOW(),Datum)>{lead:d}',
+                       order_by='Datum ASC', limit=1, format='json')
     for res in results['cargoquery']:
-        entry = res['title']
-        author = entry['Autor']
-        if author == "":
-            author = "Infoseite"
-        subject = entry['Titel']
-        body, calendar = format_news(entry, site.pages[entry['Page']])
-        # create event in stustanet calendar
-        event2cal(calendar)
-        # send mails to announce
-        send_mail(subject, author, body, calendar)
+        return max(0, int(res['title']['Due']) - lead * 60)
+    return None
+
+
+class RecentChanges:
+    """RecentChanges follows the recentchanges of the wiki from the time it was created"""
+
+    def __init__(self, site, namespaces, category):
+        self.site = site
+        self.namespaces = namespaces
+        self.category = category
+        # newest change seen: (timestamp, rcid)
+        result = site.get('query', list='recentchanges', rcprop='timestamp|ids', rclimit=1, formatversion=2)
+        changes = result['query']['recentchanges']
+        self.last = (changes[0]['timestamp'], changes[0]['rcid']) if changes else (None, 0)
+
+    def poll(self):
+        """returns the titles changed since the last poll"""
+        params = {'list': 'recentchanges', 'rcprop': 'title|timestamp|ids', 'rcdir': 'newer', 'rclimit': 'max',
+                  'formatversion': 2}
+        if self.last[0]:
+            params['rcstart'] = self.last[0]
+        if self.namespaces:
+            params['rcnamespace'] = self.namespaces
+        titles = set()
+        last = self.last
+        while True:
+            result = self.site.get('query', **params)
+            for change in result['query']['recentchanges']:
+                # rcstart includes the changes at the last timestamp
+                if (change['timestamp'], change['rcid']) <= self.last:
+                    continue
+                titles.add(change['title'])
+                last = max(last, (change['timestamp'], change['rcid']))
+            if 'continue' not in result:
+                break
+            params.update(result['continue'])
+        self.last = last
+        return self.relevant(titles)
+
+    def relevant(self, titles):
+        """returns the titles in the news category (all titles without category)"""
+        if not self.category or not titles:
+            return titles
+        relevant = set()
+        titles = sorted(titles)
+        for i in range(0, len(titles), TITLES_PER_QUERY):
+            result = self.site.get('query', prop='categories', clcategories='Category:' + self.category,
+                                   titles='|'.join(titles[i:i + TITLES_PER_QUERY]), formatversion=2)
+            relevant.update(page['title'] for page in result['query'].get('pages', []) if page.get('categories'))
+        return relevant
+
+
+def daemon(config, site, ledger):
+    """announces news as soon as they are edited or due
+
+    The cargoquery only runs if recentchanges shows an edit in the news namespaces/category, when the next
+    entry is due or at least every full_interval seconds.
+    """
+    poll_interval = config.getint('announce', 'poll_interval', fallback=15)
+    full_interval = config.getint('announce', 'full_interval', fallback=3600)
+    namespaces = config.get('announce', 'rc_namespaces', fallback='')
+    changes = RecentChanges(site, namespaces.replace(',', '|'), config.get('announce', 'news_category', fallback=''))
+
+    check_at = 0
+    due_at = None
+    while True:
+        now = time.monotonic()
+        try:
+            titles = changes.poll()
+            if titles:
+                print('Changed:', ', '.join(sorted(titles)))
+            if titles or now >= check_at or (due_at is not None and now >= due_at):
+                announce(config, site, ledger)
+                due = next_due(config, site)
+                due_at = None if due is None else time.monotonic() + due
+                check_at = time.monotonic() + full_interval
+        except Exception as ex:
+            # e.g. the wiki or a mail server is not reachable: try again with the next poll
+            print(f'Announce failed: {ex}', file=sys.stderr)
+            check_at = 0
+        time.sleep(poll_interval)
+
+
+def main(args):
+    parser = wikibot.argument_parser('relays news entries to the announce mailing list')
+    parser.add_argument(
+        '--daemon', help='keep running and announce news as soon as they are edited or due', action='store_true')
+    args = parser.parse_args(args[1:])
+
+    with wikibot.Bot(__file__, args) as bot:
+        config = bot.config
+        ledger = Ledger(config.get('announce', 'ledger', fallback='/var/cache/wiki-scripts/announce.sqlite'))
+        site = bot.site()
+        try:
+            if args.daemon:
+                wikibot.PROFILE.report()
+                daemon(config, site, ledger)
+            else:
+                announce(config, site, ledger)
+        finally:
+            ledger.close()
 
 
 if __name__ == '__main__':
-    sys.exit(main())
+    sys.exit(main(sys.argv))
@@ -1,28 +1,31 @@
 #! /usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-import configparser
 import html
 import sys
 import urllib.request
 from datetime import date
 
-import mwclient
-from bs4 import BeautifulSoup
+import wikibot
 
 
-def main():
-    config = configparser.RawConfigParser()
-    config.read('mensa.ini')
-    cfg = config.get
+def main(args):
+    args = wikibot.argument_parser("updates the wiki with today's menu of the canteen").parse_args(args[1:])
+    with wikibot.Bot(__file__, args) as bot:
+        update(bot)
+
+
+def update(bot):
+    cfg = bot.config.get
 
     speisen = {}
 
     proxy_handler = urllib.request.ProxyHandler(
         {'http': cfg('mensa', 'proxy')})
     opener = urllib.request.build_opener(proxy_handler)
-    page = opener.open(cfg('mensa', 'url')).read()
-    soup = BeautifulSoup(page, 'html.parser')
+    page = bot.fetch(cfg('mensa', 'url'), opener)
+    bs4 = wikibot.lazy_import('bs4')
+    soup = bs4.BeautifulSoup(page, 'html.parser')
 
     try:
         today = soup.find(attrs={'class': 'heute_' + date.today().strftime(
@@ -39,12 +42,6 @@ def main():
         print(ex)
         speisen = None
 
-    site = mwclient.Site(cfg(
-        'mwclient', 'site'), path=cfg('mwclient', 'path'))
-    site.login(cfg('mwclient', 'user'), cfg('mwclient', 'pass'))
-
-    page = site.Pages['Vorlage:Mensa-Heute']
-
     text = ''
     if speisen:
         for speise in speisen:
@@ -53,8 +50,8 @@ def main():
     else:
         text = text + 'Heute nix\n'
 
-    page.save(text, summary='Mensa Essen ' + date.today().strftime('%Y-%m-%d'))
+    bot.save_page('Vorlage:Mensa-Heute', text, summary='Mensa Essen ' + date.today().strftime('%Y-%m-%d'))
 
 
 if __name__ == '__main__':
-    sys.exit(main())
+    sys.exit(main(sys.argv))
@@ -2,16 +2,13 @@
 # -*- coding: utf-8 -*-
 
 
-import configparser
 import json
 import locale
-import os
 import sys
-import urllib.request
 from datetime import date
 from datetime import datetime
 
-import mwclient
+import wikibot
 
 WIKITEXT_DE = '''
 |style="vertical-align:bottom;"| %s
@@ -41,37 +38,35 @@ def wikify_date(obj, wiki_text):
     return text
 
 
-def main():
-    config = configparser.RawConfigParser()
-    config.read(os.path.dirname(os.path.realpath(__file__)) + '/sss.ini')
-    cfg = config.get
+def main(args):
+    args = wikibot.argument_parser('updates the office hours in the wiki').parse_args(args[1:])
+    with wikibot.Bot(__file__, args) as bot:
+        update(bot)
 
-    opener = urllib.request.build_opener()
-    page = opener.open(cfg('sss', 'url')).read()
 
-    appointments = [convert_date(x) for x in json.loads(page)]
+def update(bot):
+    cfg = bot.config.get
+
+    page = bot.fetch(cfg('sss', 'url'))
 
-    site = mwclient.Site(cfg('mwclient', 'site'), path=cfg('mwclient', 'path'))
-    site.login(cfg('mwclient', 'user'), cfg('mwclient', 'pass'))
+    appointments = [convert_date(x) for x in json.loads(page)]
 
     # deutsche version
 
     locale.setlocale(locale.LC_TIME, "de_DE.UTF-8")
     wiki_lines = [wikify_date(x, WIKITEXT_DE) for x in appointments]
 
-    page = site.Pages['Vorlage:Sprechstunden']
-    page.edit("{|" + "|-".join(wiki_lines) + "|}",
-              summary='Sprechstunden ' + date.today().strftime('%Y-%m-%d'))
+    bot.save_page('Vorlage:Sprechstunden', "{|" + "|-".join(wiki_lines) + "|}",
+                  summary='Sprechstunden ' + date.today().strftime('%Y-%m-%d'))
 
     # englische version
 
     locale.setlocale(locale.LC_TIME, "en_US.UTF-8")
     wiki_lines = [wikify_date(x, WIKITEXT_EN) for x in appointments]
 
-    page = site.Pages['Vorlage:Sprechstunden/en']
-    page.edit("{|" + "|-".join(wiki_lines) + "|}",
-              summary='Sprechstunden ' + date.today().strftime('%Y-%m-%d'))
+    bot.save_page('Vorlage:Sprechstunden/en', "{|" + "|-".join(wiki_lines) + "|}",
+                  summary='Sprechstunden ' + date.today().strftime('%Y-%m-%d'))
 
 
 if __name__ == '__main__':
-    sys.exit(main())
+    sys.exit(main(sys.argv))
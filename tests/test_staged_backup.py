@@ -0,0 +1,56 @@
+"""Staged upgrades must archive the live stage dir, not only the wiki dir symlink (requires borg)"""
+
+import os
+import shutil
+import subprocess
+
+import pytest
+
+import upgrade
+
+pytestmark = pytest.mark.skipif(shutil.which('borg') is None, reason='borg is not installed')
+
+
+def test_staged_archive_contains_wiki_files(tmp_path):
+    for stage in ('a', 'b'):
+        os.makedirs(tmp_path / 'stage' / stage)
+    (tmp_path / 'stage' / 'a' / 'LocalSettings.php').write_text('<?php\n')
+    os.symlink(tmp_path / 'stage' / 'a', tmp_path / 'wiki')
+    os.makedirs(tmp_path / 'dump')
+    (tmp_path / 'dump' / 'db_dump.sql').write_text('-- dump\n')
+
+    config_file = tmp_path / 'upgrade.ini'
+    config_file.write_text(f"""[env]
+proxy=
+php_service=php-fpm.service
+composer_home={tmp_path}/composer
+state_dir={tmp_path}/state/
+
+[wiki]
+dir={tmp_path}/wiki/
+staged=yes
+stage_dirs={tmp_path}/stage/a,{tmp_path}/stage/b
+extensions_git=
+skins_git=
+check_url=http://127.0.0.1/
+
+[backup]
+db_dump_dir={tmp_path}/dump/
+borg_base={tmp_path}/borg_base
+borg_dir={tmp_path}/borg_repo
+db_name=wiki
+db_user=wiki
+db_pass=wiki
+""")
+    updater = upgrade.MediaWikiUpdater(out_simple=True, config_file=str(config_file))
+    env = updater.borg_env()
+    subprocess.run(['borg', 'init', '--encryption', 'none'], env=env, check=True)
+
+    assert updater.backup_files_borg() == 0
+
+    archive = subprocess.run(['borg', 'list', '--short'], env=env, check=True, capture_output=True,
+                             text=True).stdout.split()[0]
+    paths = subprocess.run(['borg', 'list', '--short', '::' + archive], env=env, check=True, capture_output=True,
+                           text=True).stdout.splitlines()
+    assert str(tmp_path / 'stage' / 'a' / 'LocalSettings.php').lstrip('/') in paths
+    assert str(tmp_path / 'dump' / 'db_dump.sql').lstrip('/') in paths
@@ -30,19 +30,413 @@ import sys
 import os
 import re
 import configparser
-import subprocess
 import argparse
+import asyncio
+import contextlib
+import fcntl
+import glob
+import hashlib
+import collections
 import time
+import json
+import math
+import shutil
+import signal
+import threading
+import resource
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
 
 import requests
 
 
+CommandResult = collections.namedtuple('CommandResult', ['returncode', 'stdout', 'stderr', 'timed_out'])
+
+# archives of the backup pre-phase, see MediaWikiUpdater.backup_files_pre
+PRE_ARCHIVE_SUFFIX = '-pre'
+
+# timeout of CommandRunner commands which stands for the timeout of the runner, None means no timeout
+DEFAULT_TIMEOUT = object()
+
+# last line of a complete mysqldump, missing if the dump was cut off
+DUMP_TRAILER = b'-- Dump completed'
+
+# changes to these files require update.php: schema patches, core updaters and schema hooks of extensions
+SCHEMA_FILES = re.compile(r'(^|/)sql/|\.sql$|(^|/)maintenance/archives/|(^|/)includes/installer/|schema', re.IGNORECASE)
+SCHEMA_HOOKS = re.compile(r'LoadExtensionSchemaUpdates|schema', re.IGNORECASE)
+
+
+class CommandRunner:
+    """CommandRunner runs argument lists as subprocesses on an asyncio event loop in a background thread
+
+    Output is read line by line and passed to on_line, commands are killed after their timeout (by default the
+    timeout of the runner, None for no timeout) and independent commands can be run concurrently with run_many.
+    """
+
+    def __init__(self, timeout=None, on_line=None):
+        self.timeout = timeout
+        self.on_line = on_line or print
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+
+    def call(self, coro):
+        """runs coro on the event loop and returns its result, may be called from any thread"""
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        try:
+            return future.result()
+        except BaseException:
+            # e.g. KeyboardInterrupt, the running commands are killed on cancellation
+            future.cancel()
+            raise
+
+    @staticmethod
+    def kill(proc):
+        if proc.returncode is None:
+            try:
+                os.killpg(proc.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+
+    async def read_lines(self, stream, lines, echo):
+        while True:
+            line = await stream.readline()
+            if not line:
+                return
+            line = line.decode('utf-8', 'replace').rstrip('\r\n')
+            lines.append(line)
+            if echo:
+                self.on_line(line)
+
+    @staticmethod
+    async def spawn(args, cwd=None, env=None, stdin=asyncio.subprocess.DEVNULL, stdout=asyncio.subprocess.PIPE):
+        # a new session per command, so it can be killed with all its children
+        return await asyncio.create_subprocess_exec(*args, cwd=cwd, env=env, stdin=stdin, stdout=stdout,
+                                                    stderr=asyncio.subprocess.PIPE, start_new_session=True,
+                                                    limit=1 << 24)
+
+    def not_found(self, args, error, quiet=False):
+        # like a shell, a command that cannot be started fails with 127
+        if not quiet:
+            self.on_line(args[0] + ': ' + error.strerror)
+        return CommandResult(127, '', args[0] + ': ' + error.strerror, False)
+
+    async def wait(self, procs, tasks, timeout):
+        """waits for tasks, kills procs after timeout seconds or on cancellation, returns True on timeout"""
+        if timeout is DEFAULT_TIMEOUT:
+            timeout = self.timeout
+        try:
+            await asyncio.wait_for(asyncio.gather(*tasks), timeout)
+        except asyncio.TimeoutError:
+            for proc in procs:
+                self.kill(proc)
+            for proc in procs:
+                await proc.wait()
+            return True
+        finally:
+            for proc in procs:
+                self.kill(proc)
+        return False
+
+    async def run(self, args, cwd=None, *, env=None, timeout=DEFAULT_TIMEOUT, capture=False, quiet=False, stdout=None):
+        """runs args and returns a CommandResult
+
+        With capture stdout is only returned and not passed to on_line, quiet suppresses all output.
+        stdout can be a file object which receives the output instead.
+        """
+        try:
+            proc = await self.spawn(args, cwd=cwd, env=env, stdout=stdout or asyncio.subprocess.PIPE)
+        except OSError as e:
+            return self.not_found(args, e, quiet)
+        out = []
+        err = []
+        tasks = [self.read_lines(proc.stderr, err, not quiet), proc.wait()]
+        if stdout is None:
+            tasks.append(self.read_lines(proc.stdout, out, not (capture or quiet)))
+        timed_out = await self.wait([proc], tasks, timeout)
+        return CommandResult(proc.returncode, '\n'.join(out).strip(), '\n'.join(err).strip(), timed_out)
+
+    async def run_many(self, commands, limit=None):
+        """runs commands (dicts of run arguments) concurrently, at most limit at a time, results are in order"""
+        semaphore = asyncio.Semaphore(limit or max(1, len(commands)))
+
+        async def run(command):
+            async with semaphore:
+                return await self.run(**command)
+        return await asyncio.gather(*(run(command) for command in commands))
+
+    async def pipe(self, src_args, dst_args, cwd=None, *, env=None, timeout=DEFAULT_TIMEOUT, stdout=None,
+                   on_progress=None, src_trailer=None):
+        """runs src_args | dst_args and returns both CommandResults and the number of bytes piped
+
+        The data is pumped through this process to count it, on_progress is called with the total after
+        every chunk. env and cwd apply to dst, its stdout is captured unless stdout is a file object.
+        If src fails, dst is killed before its input is closed, so it does not finish with truncated data.
+        With src_trailer src also fails (returncode 1) unless the last line of its output starts with it.
+        The returncode of a command that was never started or stopped because the other one could not be, is None.
+        """
+        try:
+            src = await self.spawn(src_args)
+        except OSError as e:
+            return self.not_found(src_args, e), CommandResult(None, '', '', False), 0
+        try:
+            dst = await self.spawn(dst_args, cwd=cwd, env=env, stdin=asyncio.subprocess.PIPE,
+                                   stdout=stdout or asyncio.subprocess.PIPE)
+        except OSError as e:
+            self.kill(src)
+            await src.wait()
+            return CommandResult(None, '', '', False), self.not_found(dst_args, e), 0
+        total = 0
+        tail = b''
+        complete = src_trailer is None
+        src_err = []
+        dst_out = []
+        dst_err = []
+
+        async def pump():
+            nonlocal total, tail, complete
+            try:
+                while True:
+                    chunk = await src.stdout.read(1 << 20)
+                    if not chunk:
+                        break
+                    dst.stdin.write(chunk)
+                    await dst.stdin.drain()
+                    total += len(chunk)
+                    if src_trailer is not None:
+                        tail = (tail + chunk)[-4096:]
+                    if on_progress:
+                        on_progress(total)
+            except (BrokenPipeError, ConnectionResetError):
+                self.kill(src)
+            if src_trailer is not None:
+                complete = tail.rstrip(b'\r\n').rsplit(b'\n', 1)[-1].startswith(src_trailer)
+            if await src.wait() or not complete:
+                self.kill(dst)
+            try:
+                dst.stdin.close()
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+            await dst.wait()
+
+        tasks = [pump(), self.read_lines(src.stderr, src_err, True), self.read_lines(dst.stderr, dst_err, True)]
+        if stdout is None:
+            tasks.append(self.read_lines(dst.stdout, dst_out, False))
+        timed_out = await self.wait([src, dst], tasks, timeout)
+        src_ret = src.returncode if complete or src.returncode else 1
+        return (CommandResult(src_ret, '', '\n'.join(src_err).strip(), timed_out),
+                CommandResult(dst.returncode, '\n'.join(dst_out).strip(), '\n'.join(dst_err).strip(), timed_out),
+                total)
+
+
+class RefCache:
+    """RefCache keeps the results of git ls-remote on disk, keyed by remote url and ref patterns"""
+
+    def __init__(self, path, ttl):
+        self.path = path
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        try:
+            with open(path, encoding='utf-8') as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            self.entries = {}
+
+    def get(self, url):
+        with self.lock:
+            entry = self.entries.get(url)
+        if entry and time.time() - entry['time'] < self.ttl:
+            return entry['refs']
+        return None
+
+    def put(self, url, refs):
+        with self.lock:
+            now = time.time()
+            # expired entries are only read again after a new ls-remote, keep the file small
+            self.entries = {key: entry for key, entry in self.entries.items() if now - entry['time'] < self.ttl}
+            self.entries[url] = {'time': now, 'refs': refs}
+            try:
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                with open(self.path + '.tmp', 'w', encoding='utf-8') as f:
+                    json.dump(self.entries, f)
+                os.replace(self.path + '.tmp', self.path)
+            except OSError:
+                pass  # the cache is only an optimization
+
+
+class RefIndex:
+    """RefIndex maps the REL branches and x.y.0 release tags of a repository to version tuples"""
+
+    BRANCH_RE = re.compile('REL([0-9]+)_([0-9]+)')
+    TAG_RE = re.compile('([0-9]+)\\.([0-9]+)\\.0')
+
+    def __init__(self, refs):
+        """refs is an iterable of full ref names, e.g. refs/heads/REL1_39 or refs/tags/1.39.0"""
+        self.branches = {}
+        self.releases = set()
+        for ref in refs:
+            if ref.startswith('refs/tags/'):
+                m = self.TAG_RE.fullmatch(ref[len('refs/tags/'):])
+                if m:
+                    self.releases.add((int(m.group(1)), int(m.group(2))))
+                continue
+            for prefix in ('refs/heads/', 'refs/remotes/origin/'):
+                m = self.BRANCH_RE.fullmatch(ref[len(prefix):]) if ref.startswith(prefix) else None
+                if m:
+                    self.branches[(int(m.group(1)), int(m.group(2)))] = m.group(0)
+
+        versions = sorted(self.branches)
+        self.sorted_branches = [self.branches[v] for v in versions]
+        stable = [v for v in versions if v in self.releases]
+        self.newest_branch = self.branches[versions[-1]] if versions else None
+        self.newest_stable = self.branches[stable[-1]] if stable else None
+        # branches newer than the newest stable release
+        self.unstable = [self.branches[v] for v in versions if not stable or v > stable[-1]]
+
+    @classmethod
+    def parse_version(cls, version):
+        """returns (major, minor) for REL1_39, 1.39 or 1.39.x and None otherwise"""
+        m = cls.BRANCH_RE.fullmatch(version) or re.fullmatch('([0-9]+)\\.([0-9]+)(\\.[0-9]+)?', version)
+        if not m:
+            return None
+        return (int(m.group(1)), int(m.group(2)))
+
+    def is_stable(self, version):
+        return self.parse_version(version) in self.releases
+
+
+class UpgradeReport:
+    """UpgradeReport records timings of all steps and writes them as JSON and Prometheus textfile"""
+
+    def __init__(self, prefix='wiki_upgrade'):
+        # metric name prefix, runs of different kinds write separate textfiles
+        self.prefix = prefix
+        self.start = time.time()
+        self.steps = []
+        self.current = None
+        self.service_down = False
+        self.downtime_start = None
+        self.downtime = 0.0
+        # additional gauges, e.g. warm-up latencies
+        self.values = {}
+
+    @staticmethod
+    def children_cpu():
+        usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        return usage.ru_utime + usage.ru_stime
+
+    def begin(self, name):
+        self.end()
+        self.current = {'name': name, 'start': time.time(), 'bytes': {}, 'downtime': self.service_down,
+                        'output': [], '_clock': time.monotonic(), '_cpu': self.children_cpu()}
+
+    def end(self):
+        if not self.current:
+            return
+        step = self.current
+        step['duration'] = round(time.monotonic() - step.pop('_clock'), 3)
+        step['cpu'] = round(self.children_cpu() - step.pop('_cpu'), 3)
+        self.steps.append(step)
+        self.current = None
+
+    def add_output(self, line):
+        """keeps the last lines of command output of the current step"""
+        if self.current:
+            self.current['output'] = self.current['output'][-49:] + [line]
+
+    def add_bytes(self, kind, size):
+        if self.current:
+            self.current['bytes'][kind] = self.current['bytes'].get(kind, 0) + size
+
+    def set_service_down(self, down):
+        if down and not self.service_down:
+            self.downtime_start = time.monotonic()
+        elif not down and self.service_down:
+            self.downtime += time.monotonic() - self.downtime_start
+        self.service_down = down
+
+    def as_dict(self, exit_code):
+        self.end()
+        downtime = self.downtime
+        if self.service_down:
+            downtime += time.monotonic() - self.downtime_start
+        return {
+            'start': self.start,
+            'duration': round(time.time() - self.start, 3),
+            'downtime': round(downtime, 3),
+            'exit_code': exit_code,
+            'steps': self.steps,
+            'values': self.values,
+        }
+
+    @staticmethod
+    def write_file(path, data):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            f.write(data)
+        os.replace(path + '.tmp', path)
+
+    def write_json(self, path, exit_code):
+        self.write_file(path, json.dumps(self.as_dict(exit_code), indent=2) + '\n')
+
+    def write_prometheus(self, path, exit_code):
+        """writes a textfile for the node_exporter textfile collector"""
+        report = self.as_dict(exit_code)
+        p = self.prefix
+
+        def label(value):
+            return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+        durations = {}
+        cpu = {}
+        transferred = {}
+        for step in report['steps']:
+            durations[step['name']] = durations.get(step['name'], 0) + step['duration']
+            cpu[step['name']] = cpu.get(step['name'], 0) + step['cpu']
+            for kind, size in step['bytes'].items():
+                key = (step['name'], kind)
+                transferred[key] = transferred.get(key, 0) + size
+
+        lines = [
+            f'# HELP {p}_last_run_timestamp_seconds Start time of the last run.',
+            f'# TYPE {p}_last_run_timestamp_seconds gauge',
+            f'{p}_last_run_timestamp_seconds {report["start"]:.0f}',
+            f'# HELP {p}_exit_code Exit code of the last run.',
+            f'# TYPE {p}_exit_code gauge',
+            f'{p}_exit_code {report["exit_code"]}',
+            f'# HELP {p}_duration_seconds Wall-clock time of the last run.',
+            f'# TYPE {p}_duration_seconds gauge',
+            f'{p}_duration_seconds {report["duration"]}',
+            f'# HELP {p}_downtime_seconds Time the PHP service was stopped during the last run.',
+            f'# TYPE {p}_downtime_seconds gauge',
+            f'{p}_downtime_seconds {report["downtime"]}',
+            f'# HELP {p}_step_duration_seconds Wall-clock time of the steps of the last run.',
+            f'# TYPE {p}_step_duration_seconds gauge',
+        ]
+        lines += [f'{p}_step_duration_seconds{{step="{label(name)}"}} {value:.3f}'
+                  for name, value in durations.items()]
+        lines += [
+            f'# HELP {p}_step_cpu_seconds CPU time of subprocesses in the steps of the last run.',
+            f'# TYPE {p}_step_cpu_seconds gauge',
+        ]
+        lines += [f'{p}_step_cpu_seconds{{step="{label(name)}"}} {value:.3f}'
+                  for name, value in cpu.items()]
+        lines += [
+            f'# HELP {p}_step_bytes Bytes transferred in the steps of the last run.',
+            f'# TYPE {p}_step_bytes gauge',
+        ]
+        lines += [f'{p}_step_bytes{{step="{label(name)}",kind="{label(kind)}"}} {value}'
+                  for (name, kind), value in transferred.items()]
+        for name, value in report['values'].items():
+            lines += [f'# TYPE {p}_{name} gauge', f'{p}_{name} {value}']
+        self.write_file(path, '\n'.join(lines) + '\n')
+
+
 class MediaWikiUpdater:
     """MediaWikiUpdater is a utility for automatic updates of MediaWiki"""
 
-    def __init__(self, out_simple=False):
+    def __init__(self, out_simple=False, refresh=False, config_file=None, force_update_php=False, restore_db=False):
         config = configparser.RawConfigParser()
-        config.read(os.path.dirname(
+        config.read(config_file or os.path.dirname(
             os.path.realpath(__file__)) + '/upgrade.ini')
         cfg = config.get
 
@@ -56,23 +450,124 @@ class MediaWikiUpdater:
 
         self.borg_dir = cfg('backup', 'borg_dir')
         self.borg_base = cfg('backup', 'borg_base')
+        self.borg_compression = config.get('backup', 'borg_compression', fallback='lz4')
+        # archive wiki_dir once while the wiki is still running, so borg only reads changed files during the downtime
+        self.backup_prephase = config.getboolean('backup', 'prephase', fallback=False)
+        # repository maintenance (prune, compact, check) runs while the wiki is up
+        # after: at the end of every upgrade, scheduled: only with --maintenance
+        self.maintenance = config.get('backup', 'maintenance', fallback='after')
+        if self.maintenance not in ('after', 'scheduled'):
+            raise ValueError('invalid maintenance: ' + self.maintenance)
+        # borg compact requires borg >= 1.2
+        self.borg_compact = config.getboolean('backup', 'borg_compact', fallback=False)
+        # no, repository or full (repository and archives)
+        self.borg_check = config.get('backup', 'borg_check', fallback='no')
+        if self.borg_check not in ('no', 'repository', 'full'):
+            raise ValueError('invalid borg_check: ' + self.borg_check)
+
+        # file: dump the database to db_dump_dir before the borg backup
+        # stream: pipe mysqldump directly into borg create (requires borg >= 1.2)
+        # tables: dump only changed tables to one compressed file per table in db_dump_dir/tables/
+        self.db_backup_mode = config.get('backup', 'db_backup_mode', fallback='file')
+        if self.db_backup_mode not in ('file', 'stream', 'tables'):
+            raise ValueError('invalid db_backup_mode: ' + self.db_backup_mode)
+        # update_time: UPDATE_TIME, TABLE_ROWS and DATA_LENGTH of information_schema.TABLES (cheap),
+        # checksum: CHECKSUM TABLE (exact, but reads every table completely)
+        self.db_change_detect = config.get('backup', 'db_change_detect', fallback='update_time')
+        if self.db_change_detect not in ('checksum', 'update_time'):
+            raise ValueError('invalid db_change_detect: ' + self.db_change_detect)
+        # tables which are dumped without data, e.g. caches
+        self.db_skip_data = [t for t in config.get('backup', 'db_skip_data', fallback='').split(',') if t]
 
         self.composer_home = cfg('env', 'composer_home')
+        # vendor trees keyed by the fingerprint of the composer manifests, the vendor_cache_keep newest are kept
+        self.vendor_cache_dir = config.get('env', 'vendor_cache_dir', fallback='')
+        self.vendor_cache_keep = config.getint('env', 'vendor_cache_keep', fallback=3)
         self.php_service = cfg('env', 'php_service')
+        self.service_cmd = config.get('env', 'service_cmd', fallback='sudo /bin/systemctl').split()
         self.proxy = cfg('env', 'proxy')
 
-        self.extensions_dir = self.wiki_dir + 'extensions/'
         self.extensions_git = cfg('wiki', 'extensions_git').split(',')
-        self.extensions = [sub for sub in os.listdir(
-            self.extensions_dir) if os.path.isdir(os.path.join(self.extensions_dir, sub))]
-
-        self.skins_dir = self.wiki_dir + 'skins/'
         self.skins_git = cfg('wiki', 'skins_git').split(',')
-        self.skins = [sub for sub in os.listdir(
-            self.skins_dir) if os.path.isdir(os.path.join(self.skins_dir, sub))]
+        # full: plain clones, blobless/shallow: extensions and skins (and their submodules) only fetch their
+        # release branch without tags, blobs on demand (git >= 2.36) or only the newest commit
+        self.clone_mode = config.get('wiki', 'clone_mode', fallback='full')
+        clone_args = {'full': [], 'blobless': ['--filter=blob:none'], 'shallow': ['--depth=1']}
+        if self.clone_mode not in clone_args:
+            raise ValueError('invalid clone_mode: ' + self.clone_mode)
+        self.clone_args = clone_args[self.clone_mode]
+        # gc and commit-graph of the extension and skin repositories during maintenance
+        self.git_maintenance_enabled = config.getboolean('wiki', 'git_maintenance', fallback=self.clone_mode != 'full')
 
         self.check_url = cfg('wiki', 'check_url')
 
+        # warm-up after the upgrade, pages are fetched through the article path of check_url
+        self.ready_timeout = config.getint('warmup', 'ready_timeout', fallback=60)
+        self.warmup_base = config.get('warmup', 'base_url', fallback=self.check_url.rsplit('/', 1)[0] + '/')
+        self.warmup_pages = [p for p in config.get('warmup', 'pages', fallback='').split(',') if p]
+        # top_n most viewed pages from the api (requires Extension:PageViewInfo)
+        self.warmup_api = config.get('warmup', 'api_url', fallback=self.warmup_base + 'api.php')
+        self.warmup_top_n = config.getint('warmup', 'top_n', fallback=0)
+        self.warmup_concurrency = config.getint('warmup', 'concurrency', fallback=4)
+        # fail if the p95 latency exceeds max_p95 seconds or max_regression times the p95 of the last run
+        self.warmup_max_p95 = config.getfloat('warmup', 'max_p95', fallback=0)
+        self.warmup_max_regression = config.getfloat('warmup', 'max_regression', fallback=0)
+
+        # staged upgrades: dir is a symlink to one of stage_dirs, the upgrade is prepared in the other one
+        self.staged = config.getboolean('wiki', 'staged', fallback=False)
+        self.stage_dirs = [d.rstrip('/') + '/' for d in config.get('wiki', 'stage_dirs', fallback='').split(',')]
+        if self.staged and len(self.stage_dirs) != 2:
+            raise ValueError('staged upgrades require exactly two stage_dirs')
+        if self.staged and self.db_backup_mode == 'tables':
+            # the tables are dumped one by one, only consistent while php is stopped
+            raise ValueError('db_backup_mode=tables is not supported with staged upgrades')
+        # the tree modified by the upgrade, differs from wiki_dir during staged upgrades
+        self.work_dir = self.wiki_dir
+
+        # number of git modules checked for updates at the same time
+        self.check_concurrency = config.getint('env', 'check_concurrency', fallback=4)
+
+        # commands are killed after cmd_timeout seconds (0: never), network git commands after git_timeout
+        # update.php, backups and restores are never killed
+        self.runner = CommandRunner(timeout=config.getint('env', 'cmd_timeout', fallback=0) or None,
+                                    on_line=self.output_line)
+        self.git_timeout = config.getint('env', 'git_timeout', fallback=600)
+
+        # ls-remote: compare local HEADs against the remote refs without touching the working tree
+        # fetch: fetch the repositories and compare against their upstream branches
+        self.check_mode = config.get('env', 'check_mode', fallback='ls-remote')
+        if self.check_mode not in ('ls-remote', 'fetch'):
+            raise ValueError('invalid check_mode: ' + self.check_mode)
+        self.state_dir = config.get('env', 'state_dir', fallback='/var/cache/wiki-scripts/')
+        self.vendor_cache_dir = self.vendor_cache_dir or self.state_dir + 'vendor/'
+        self.ref_cache = RefCache(self.state_dir + 'refs.json',
+                                  config.getint('env', 'ref_cache_ttl', fallback=600))
+        # ignore cached remote refs
+        self.refresh = refresh
+        self.__ref_index = None
+
+        # actions of the upgrade, see new_plan
+        self.plan = None
+        # run update.php even if no schema changes were pulled
+        self.force_update_php = force_update_php
+        # state before the last upgrade, see save_rollback
+        self.rollback_file = self.state_dir + 'rollback.json'
+        # roll back automatically if the wiki does not work after the upgrade
+        self.auto_rollback = config.getboolean('wiki', 'rollback', fallback=True)
+        # also restore the database dump of the backup when rolling back after update.php
+        self.restore_db = restore_db or config.getboolean('backup', 'rollback_restore_db', fallback=False)
+        self.plan_file = self.state_dir + 'plan.json'
+        # held while creating archives and during maintenance, so they never overlap
+        self.borg_lock_file = self.state_dir + 'borg.lock'
+
+        self.report = UpgradeReport()
+        self.report_file = config.get('env', 'report_file', fallback=self.state_dir + 'report.json')
+        self.prometheus_file = config.get('env', 'prometheus_file', fallback='')
+        # reports of --maintenance runs
+        self.maintenance_report_file = config.get('env', 'maintenance_report_file',
+                                                  fallback=self.state_dir + 'maintenance.json')
+        self.maintenance_prometheus_file = config.get('env', 'maintenance_prometheus_file', fallback='')
+
         # Simple output for non-terminal?
         self.out_simple = out_simple
 
@@ -81,6 +576,7 @@ class MediaWikiUpdater:
         print(msg)
 
     def step(self, msg):
+        self.report.begin(msg)
         if self.out_simple:
             print('\n:: ' + msg + ' ::')
             return
@@ -88,7 +584,7 @@ class MediaWikiUpdater:
 
     def info(self, key, value=''):
         if self.out_simple:
-            if key == '':
+            if value == '':
                 print('[INFO] ' + key)
             else:
                 print('[INFO] ' + key + ': ' + value)
@@ -119,144 +615,671 @@ class MediaWikiUpdater:
             print('\x1b[40m\x1b[92mSUCCESS\x1b[0m: ' + msg)
         sys.exit(code)
 
-    def get_cmd(self, cmd, cwd=None):
-        if not cwd:
-            cwd = self.wiki_dir
-        sys.stdout.flush()
-        with subprocess.Popen(cmd, cwd=cwd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE) as proc:
-            out = proc.communicate()
-        return (out[0].decode('utf-8').strip(), out[1].decode('utf-8').strip())
-
-    def run_cmd(self, cmd, cwd=None):
-        if not cwd:
-            cwd = self.wiki_dir
-        sys.stdout.flush()
-        return subprocess.Popen(cmd, cwd=cwd, shell=True).wait()
-
-    @staticmethod
-    def get_branches_str(data):
-        return re.findall('origin/(REL[0-9]_[0-9][0-9]?)\\n', data, re.S)
+    def output_line(self, line):
+        print(line, flush=True)
+        self.report.add_output(line)
+
+    def exec_cmd(self, args, cwd=None, **kwargs):
+        """runs args (see CommandRunner.run) in work_dir and returns the CommandResult"""
+        res = self.runner.call(self.runner.run(args, cwd=cwd or self.work_dir, **kwargs))
+        if res.timed_out:
+            self.warn(' '.join(args[:2]) + ' timed out')
+        return res
+
+    def get_cmd(self, args, cwd=None, timeout=DEFAULT_TIMEOUT):
+        """returns stdout and stderr of args"""
+        res = self.exec_cmd(args, cwd=cwd, timeout=timeout, capture=True, quiet=True)
+        return (res.stdout, res.stderr)
+
+    def run_cmd(self, args, cwd=None, *, quiet=False, env=None, timeout=DEFAULT_TIMEOUT, stdout=None):
+        """runs args with its output passed through and returns the return code"""
+        return self.exec_cmd(args, cwd=cwd, quiet=quiet, env=env, timeout=timeout, stdout=stdout).returncode
+
+    def pipe_cmd(self, src_args, dst_args, cwd=None, *, env=None, timeout=DEFAULT_TIMEOUT, stdout=None,
+                 progress_msg=None, src_trailer=None):
+        """runs src_args | dst_args (see CommandRunner.pipe), returns the return code, stdout of dst and bytes piped
+
+        With progress_msg the number of bytes piped is reported every 10 seconds.
+        """
+        start = time.monotonic()
+        last = [start]
+
+        def progress(total):
+            if progress_msg and time.monotonic() - last[0] >= 10:
+                last[0] = time.monotonic()
+                self.info(progress_msg, self.format_throughput(total, last[0] - start))
+
+        src, dst, total = self.runner.call(self.runner.pipe(src_args, dst_args, cwd=cwd or self.work_dir, env=env,
+                                                            timeout=timeout, stdout=stdout, on_progress=progress,
+                                                            src_trailer=src_trailer))
+        if src.timed_out:
+            self.warn(src_args[0] + ' | ' + dst_args[0] + ' timed out')
+        elif src.returncode:
+            self.warn(src_args[0] + ' failed')
+        if progress_msg:
+            self.info(progress_msg, self.format_throughput(total, time.monotonic() - start))
+        return (src.returncode or dst.returncode, dst.stdout, total)
+
+    def call_cmd(self, args, cwd=None, env=None, timeout=DEFAULT_TIMEOUT):
+        """runs args and returns the return code and stdout, stderr is passed through"""
+        res = self.exec_cmd(args, cwd=cwd, env=env, timeout=timeout, capture=True)
+        return (res.returncode, res.stdout)
+
+    def git_object_size(self, git_dir):
+        """returns the size of the object store of the repository in git_dir in bytes"""
+        out = self.get_cmd(['git', 'count-objects', '-v'], cwd=git_dir)[0]
+        stats = dict(line.split(': ', 1) for line in out.splitlines() if ': ' in line)
+        return (int(stats.get('size', 0)) + int(stats.get('size-pack', 0))) * 1024
+
+    def add_borg_stats(self, out):
+        """adds the sizes reported by borg create --json to the report"""
+        try:
+            archive = json.loads(out)['archive']
+            stats = archive['stats']
+            self.report.add_bytes('borg_original', stats['original_size'])
+            self.report.add_bytes('borg_deduplicated', stats['deduplicated_size'])
+        except (ValueError, KeyError, TypeError):
+            return
+        self.info('borg', self.format_throughput(stats['original_size'], archive.get('duration', 0)) + ' read, ' +
+                  f"{stats['deduplicated_size'] / (1 << 20):.1f} MiB new")
+
+    def write_report(self, exit_code):
+        report = self.report.as_dict(exit_code)
+        self.step('Timings')
+        rows = [('STEP', 'SECONDS', 'CPU', 'DOWN')]
+        for step in report['steps']:
+            rows.append((step['name'], f"{step['duration']:.1f}", f"{step['cpu']:.1f}",
+                         'yes' if step['downtime'] else ''))
+        self.table(rows)
+        self.info('total', f"{report['duration']:.1f}s, downtime {report['downtime']:.1f}s")
+        self.report.current = None  # do not report the timings step itself
+        try:
+            if self.report_file:
+                self.report.write_json(self.report_file, exit_code)
+            if self.prometheus_file:
+                self.report.write_prometheus(self.prometheus_file, exit_code)
+        except OSError as ex:
+            self.warn('could not write report: ' + str(ex))
+
+    def use_maintenance_report(self):
+        """reports to the maintenance files, so a maintenance run does not replace the report of the last upgrade"""
+        self.report.prefix = 'wiki_maintenance'
+        self.report_file = self.maintenance_report_file
+        self.prometheus_file = self.maintenance_prometheus_file
+
+    def table(self, rows):
+        widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+        for row in rows:
+            self.log('  '.join(cell.ljust(widths[i]) for i, cell in enumerate(row)).rstrip())
+
+    def core_ref_patterns(self):
+        """returns the refs of the mediawiki repository needed to find new versions and the tracked branch"""
+        patterns = ['refs/heads/REL*', 'refs/tags/*']
+        branch = self.module_branch(self.wiki_dir)
+        if branch and not branch.startswith('REL'):
+            patterns.append('refs/heads/' + branch)
+        return patterns
+
+    def remote_refs(self, git_dir=None, patterns=None):
+        """returns {refname: sha} of the refs of the origin remote matching patterns (default: core_ref_patterns)
+        via git ls-remote or None on error"""
+        git_dir = git_dir or self.wiki_dir
+        patterns = patterns or self.core_ref_patterns()
+        url = self.get_cmd(['git', 'remote', 'get-url', 'origin'], cwd=git_dir)[0]
+        if not url:
+            return None
+        key = url + ' ' + ' '.join(patterns)
+        refs = None if self.refresh else self.ref_cache.get(key)
+        if refs is None:
+            res = self.exec_cmd(['git', 'ls-remote', 'origin'] + patterns, cwd=git_dir, timeout=self.git_timeout,
+                                capture=True, quiet=True)
+            if res.returncode:
+                return None
+            refs = {}
+            for line in res.stdout.splitlines():
+                sha, ref = line.split('\t', 1)
+                refs[ref] = sha
+            self.ref_cache.put(key, refs)
+        return refs
+
+    def remote_head(self, git_dir, version=None):
+        """returns the remote commit of the given branch (default: upstream of HEAD) or None"""
+        branch = version or self.module_branch(git_dir)
+        if not branch:
+            return None
+        ref = 'refs/heads/' + branch
+        # mediawiki shares one listing with ref_index
+        patterns = None if os.path.realpath(git_dir) == os.path.realpath(self.wiki_dir) else [ref]
+        refs = self.remote_refs(git_dir, patterns)
+        if refs is None:
+            return None
+        return refs.get(ref)
 
-    @staticmethod
-    def __branch_version(version_str):
-        if len(version_str) == 7:
-            return int(version_str[3]) * 100 + int(version_str[5]) * 10 + int(version_str[6])
-        if len(version_str) == 6:
-            return int(version_str[3]) * 100 + int(version_str[5])
-        return -1
+    def ref_index(self):
+        """returns the RefIndex of the mediawiki repository, built from a single ref listing"""
+        if self.__ref_index is None:
+            if self.check_mode == 'ls-remote':
+                refs = self.remote_refs() or {}
+            else:
+                self.run_cmd(['git', 'fetch'], quiet=True, timeout=self.git_timeout)
+                refs = self.get_cmd(['git', 'for-each-ref', '--format=%(refname)',
+                                     'refs/remotes/origin', 'refs/tags'])[0].splitlines()
+            self.__ref_index = RefIndex(refs)
+        return self.__ref_index
 
     def version_is_stable(self, version):
-        if version.startswith('REL'):
-            version = version[3:].replace('_', '.') + ".0"
         # check if 1.xx.0 was tagged (initial stable release)
-        return self.get_cmd('git tag -l ' + version)[0] == version
+        return self.ref_index().is_stable(version)
 
     def get_current_version(self):
-        return self.get_cmd('git fetch && git rev-parse --abbrev-ref HEAD')[0]
+        return self.get_cmd(['git', 'rev-parse', '--abbrev-ref', 'HEAD'])[0]
 
     def get_branches(self):
-        with subprocess.Popen('git branch -r', cwd=self.wiki_dir, shell=True, stdout=subprocess.PIPE) as proc:
-            process = proc.stdout.read()
-
-        branches = sorted(self.get_branches_str(process.decode("utf-8")),
-                          key=self.__branch_version)
-        return branches
+        return self.ref_index().sorted_branches
 
     def get_newest_version(self, stable=True):
-        branches = self.get_branches()
-        if not branches:
-            return None
-        i = len(branches) - 1
-        branch = branches[i]
-        if stable:
-            while not self.version_is_stable(branch):
-                self.info(branch + " is not stable yet.")
-                if i == 0:
-                    return None
-                i -= 1
-                branch = branches[i]
-        return branch
+        index = self.ref_index()
+        if not stable:
+            return index.newest_branch
+        for branch in index.unstable:
+            self.info(branch + " is not stable yet.")
+        return index.newest_stable
 
     def backup_db(self):
         backup_name = "db_dump"
         file = self.db_dump_dir + backup_name + '.tmp'
-        ret = self.run_cmd('mysqldump' +
-                           ' -u ' + self.db_user +
-                           ' --password=' + self.db_pass +
-                           ' ' + self.db_name + ' > ' + file)
+        with open(file, 'wb') as out:
+            # a consistent snapshot without locking the tables, staged upgrades dump while the wiki is serving
+            ret = self.run_cmd(['mysqldump', '--single-transaction', '--quick', '-u', self.db_user,
+                                '--password=' + self.db_pass, self.db_name], stdout=out, timeout=None)
         if ret == 0:
+            self.report.add_bytes('db_dump', os.path.getsize(file))
             os.rename(file, self.db_dump_dir + backup_name + '.sql')
         return ret
 
+    def db_query(self, query):
+        """runs query and returns the rows as lists of columns"""
+        out = self.get_cmd(['mysql', '-N', '-B', '-u', self.db_user, '--password=' + self.db_pass,
+                            self.db_name, '-e', query])[0]
+        return [line.split('\t') for line in out.splitlines()]
+
+    def db_table_markers(self):
+        """returns {table: marker}, the marker changes whenever the content of the table changes"""
+        rows = self.db_query("SELECT TABLE_NAME, UPDATE_TIME, TABLE_ROWS, DATA_LENGTH FROM information_schema.TABLES"
+                             " WHERE TABLE_SCHEMA=DATABASE() AND TABLE_TYPE='BASE TABLE'")
+        # without an update time (e.g. InnoDB after a server restart) the table is always dumped
+        markers = {row[0]: 'NULL' if row[1] == 'NULL' else '|'.join(row[1:]) for row in rows}
+        if self.db_change_detect == 'checksum' and markers:
+            tables = [t for t in markers if t not in self.db_skip_data]
+            rows = self.db_query('CHECKSUM TABLE ' + ', '.join('`' + t + '`' for t in tables)) if tables else []
+            for name, checksum in rows:
+                markers[name.split('.', 1)[1]] = checksum
+        for table in self.db_skip_data:
+            if table in markers:
+                markers[table] = 'no-data'
+        return markers
+
+    def dump_table(self, table, file):
+        """dumps table to a gzip compressed file, rsyncable so borg can deduplicate it"""
+        dump_cmd = ['mysqldump', '--single-transaction', '--quick',
+                    '-u', self.db_user, '--password=' + self.db_pass, self.db_name, table]
+        if table in self.db_skip_data:
+            dump_cmd.insert(1, '--no-data')
+        with open(file + '.tmp', 'wb') as out:
+            ret = self.pipe_cmd(dump_cmd, ['gzip', '-n', '--rsyncable'], stdout=out, timeout=None,
+                                src_trailer=DUMP_TRAILER)[0]
+        if ret:
+            os.remove(file + '.tmp')
+            return ret
+        self.report.add_bytes('db_dump', os.path.getsize(file + '.tmp'))
+        os.replace(file + '.tmp', file)
+        return 0
+
+    def backup_db_tables(self):
+        """dumps all tables which changed since the last run to db_dump_dir/tables/<table>.sql.gz"""
+        tables_dir = self.db_dump_dir + 'tables/'
+        os.makedirs(tables_dir, exist_ok=True)
+        try:
+            with open(tables_dir + 'markers.json', encoding='utf-8') as f:
+                old_markers = json.load(f)
+        except (OSError, ValueError):
+            old_markers = {}
+
+        markers = self.db_table_markers()
+        if not markers:
+            self.warn('could not list database tables')
+            return 1
+
+        dumped = 0
+        for table, marker in sorted(markers.items()):
+            file = tables_dir + table + '.sql.gz'
+            # NULL update times are not reliable, always dump those tables
+            if marker != 'NULL' and old_markers.get(table) == marker and os.path.exists(file):
+                continue
+            ret = self.dump_table(table, file)
+            if ret:
+                self.warn('dumping table ' + table + ' failed')
+                return ret
+            dumped += 1
+
+        for file in os.listdir(tables_dir):
+            if file.endswith('.sql.gz') and file[:-len('.sql.gz')] not in markers:
+                os.remove(tables_dir + file)
+
+        with open(tables_dir + 'markers.json.tmp', 'w', encoding='utf-8') as f:
+            json.dump(markers, f, indent=2)
+        os.replace(tables_dir + 'markers.json.tmp', tables_dir + 'markers.json')
+        self.info('dumped tables', f'{dumped} of {len(markers)} changed')
+        return 0
+
+    def borg_env(self):
+        return dict(os.environ, BORG_REPO=self.borg_dir, BORG_BASE_DIR=self.borg_base)
+
+    def composer_env(self):
+        return dict(os.environ, https_proxy=self.proxy, http_proxy=self.proxy, COMPOSER_HOME=self.composer_home)
+
+    def backup_source(self):
+        """returns the directory wiki_dir points to, borg would only store the symlink of staged upgrades"""
+        return os.path.realpath(self.wiki_dir)
+
     def backup_files_borg(self):
-        cmd = f"BORG_REPO={self.borg_dir} "  \
-              f"BORG_BASE_DIR={self.borg_base} " + \
-              "borg create --compression lz4" + \
-              f" ::'{{hostname}}-{{now}}' {self.wiki_dir} " + \
-              f" {self.db_dump_dir + 'db_dump.sql'}"
-        self.info(cmd)
-        return self.run_cmd(cmd)
+        dump = 'tables/' if self.db_backup_mode == 'tables' else 'db_dump.sql'
+        cmd = ['borg', 'create', '--json', '--compression', self.borg_compression,
+               '::{hostname}-{now}', self.backup_source(), self.db_dump_dir + dump]
+        self.info(' '.join(cmd))
+        ret, out = self.call_cmd(cmd, env=self.borg_env(), timeout=None)
+        self.add_borg_stats(out)
+        return ret
 
-    def borg_prune(self):
-        cmd = f"BORG_REPO={self.borg_dir} " + \
-              f"BORG_BASE_DIR={self.borg_base} " + \
-              "borg prune --keep-within 2m"
-        self.info(cmd)
-        return self.run_cmd(cmd)
+    def backup_files_pre(self):
+        """creates a throwaway archive of wiki_dir while the wiki is running, it fills the files cache and chunk
+        index of borg, so the archive during the downtime only reads changed files; deleted by borg_maintenance"""
+        cmd = ['borg', 'create', '--json', '--compression', self.borg_compression,
+               '::{hostname}-{now}' + PRE_ARCHIVE_SUFFIX, self.backup_source()]
+        self.info(' '.join(cmd))
+        ret, out = self.call_cmd(cmd, env=self.borg_env(), timeout=None)
+        self.add_borg_stats(out)
+        return ret
 
-    def check_git_module_update(self, subdir, version=None):
-        git_dir = self.wiki_dir + subdir + '/'
+    def backup_stream_borg(self):
+        """pipes mysqldump into borg create, the dump is stored as db_dump.sql next to wiki_dir in the archive"""
+        dump_cmd = ['mysqldump', '--single-transaction', '--quick',
+                    '-u', self.db_user, '--password=' + self.db_pass, self.db_name]
+        borg_cmd = ['borg', 'create', '--json', '--compression', self.borg_compression, '--stdin-name', 'db_dump.sql',
+                    '::{hostname}-{now}', '-', self.backup_source()]
+        self.info('mysqldump ' + self.db_name + ' | ' + ' '.join(borg_cmd))
+        # stdin comes first, otherwise mysqldump blocks until borg walked wiki_dir and may hit net_write_timeout
+        # borg is killed if mysqldump fails or its dump is incomplete, so no archive with a truncated dump is committed
+        ret, out, total = self.pipe_cmd(dump_cmd, borg_cmd, cwd=self.wiki_dir, env=self.borg_env(), timeout=None,
+                                        progress_msg='database dump', src_trailer=DUMP_TRAILER)
+        self.report.add_bytes('db_dump', total)
+        self.add_borg_stats(out)
+        return ret
 
-        if version:
-            upgrade_cmd = 'git pull && git checkout '+version
-            ret = self.run_cmd(upgrade_cmd, cwd=git_dir)
+    @staticmethod
+    def format_throughput(size, seconds):
+        mib = size / (1 << 20)
+        return f'{mib:.1f} MiB in {seconds:.1f}s ({mib / max(seconds, 0.001):.1f} MiB/s)'
+
+    def backup(self, files_msg):
+        """backs up database and files according to db_backup_mode"""
+        if self.db_backup_mode == 'stream':
+            self.step('Backing up Database and ' + files_msg + ' (streamed)')
+            ret = self.backup_stream_borg()
+            if ret:
+                self.fail('Backup failed')
+            return
+
+        if self.db_backup_mode == 'tables':
+            self.step('Backing up Database (changed tables)')
+            ret = self.backup_db_tables()
         else:
-            ret = self.run_cmd('git pull', cwd=git_dir)
+            self.step('Backing up Database')
+            ret = self.backup_db()
+        if ret:
+            self.fail('Database Backup failed')
 
+        self.step('Backing up ' + files_msg)
+        ret = self.backup_files_borg()
         if ret:
-            self.warn('git pull failed for ' + subdir + '. Skipping...')
-            return False
-        local = self.get_cmd('git rev-parse @', cwd=git_dir)[0]
-        remote = self.get_cmd('git rev-parse @{u}', cwd=git_dir)[0]
-        return local != remote
+            self.fail('Files Backup failed')
+
+    @contextlib.contextmanager
+    def borg_lock(self, wait=True):
+        """holds the borg lock, yields False if it is taken and wait is False"""
+        os.makedirs(self.state_dir, exist_ok=True)
+        with open(self.borg_lock_file, 'a', encoding='utf-8') as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                if not wait:
+                    yield False
+                    return
+                self.info('waiting for borg maintenance to finish')
+                fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield True
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def borg_prune(self):
+        cmd = ['borg', 'prune', '--keep-within', '2m']
+        self.info(' '.join(cmd))
+        return self.run_cmd(cmd, env=self.borg_env())
+
+    def borg_delete_pre(self):
+        """deletes the archives of the backup pre-phase, returns the return code"""
+        ret, out = self.call_cmd(['borg', 'list', '--short', '--glob-archives', '*' + PRE_ARCHIVE_SUFFIX],
+                                 env=self.borg_env())
+        if ret or not out:
+            return ret
+        cmd = ['borg', 'delete', '::'] + out.split()
+        self.info(' '.join(cmd))
+        return self.run_cmd(cmd, env=self.borg_env())
+
+    def borg_maintenance(self, wait=True):
+        """prunes, compacts and checks the borg repository, returns the return code"""
+        self.step('Borg maintenance')
+        with self.borg_lock(wait) as locked:
+            if not locked:
+                self.warn('a backup is running, skipping borg maintenance')
+                return 0
+            ret = self.borg_delete_pre()
+            if ret:
+                self.warn('deleting the pre-phase archives failed')
+                return ret
+            ret = self.borg_prune()
+            if ret:
+                self.warn('borg prune failed')
+                return ret
+            if self.borg_compact:
+                cmd = ['borg', 'compact']
+                self.info(' '.join(cmd))
+                ret = self.run_cmd(cmd, env=self.borg_env())
+                if ret:
+                    self.warn('borg compact failed')
+                    return ret
+            if self.borg_check != 'no':
+                cmd = ['borg', 'check'] + (['--repository-only'] if self.borg_check == 'repository' else [])
+                self.info(' '.join(cmd))
+                ret = self.run_cmd(cmd, env=self.borg_env())
+                if ret:
+                    self.warn('borg check failed')
+        return ret
+
+    def git_pull(self, git_dir=None, version=None, quiet=False):
+        """pulls and checks out version if given, returns the return code"""
+        ret = self.run_cmd(['git', 'pull'], cwd=git_dir, quiet=quiet, timeout=self.git_timeout)
+        if not ret and version:
+            ret = self.run_cmd(['git', 'checkout', version], cwd=git_dir, quiet=quiet)
+        return ret
+
+    def module_branch(self, git_dir):
+        """returns the branch of origin the repository in git_dir tracks or None"""
+        upstream = self.get_cmd(['git', 'rev-parse', '--abbrev-ref', '@{u}'], cwd=git_dir)[0]
+        return upstream.split('/', 1)[1] if upstream.startswith('origin/') else None
+
+    def pin_clone(self, git_dir, branch):
+        """configures the repository in git_dir to only fetch branch without tags (and blobs on demand)"""
+        cmds = [['git', 'remote', 'set-branches', 'origin', branch],
+                ['git', 'config', 'remote.origin.tagOpt', '--no-tags']]
+        if self.clone_mode == 'blobless':
+            cmds += [['git', 'config', 'remote.origin.promisor', 'true'],
+                     ['git', 'config', 'remote.origin.partialclonefilter', 'blob:none']]
+        for cmd in cmds:
+            ret = self.run_cmd(cmd, cwd=git_dir, quiet=True)
+            if ret:
+                return ret
+        return 0
+
+    def git_fetch_module(self, git_dir, version=None, quiet=False):
+        """fetches origin without touching the working tree, blobless/shallow clones (clone_mode) stay pinned to
+        their release branch (version if given), returns the return code"""
+        if self.clone_mode == 'full':
+            return self.run_cmd(['git', 'fetch', 'origin'], cwd=git_dir, quiet=quiet, timeout=self.git_timeout)
+        branch = version or self.module_branch(git_dir)
+        if not branch:
+            self.warn(git_dir + ' does not track a branch of origin')
+            return 1
+        ret = self.pin_clone(git_dir, branch)
+        if not ret:
+            ret = self.run_cmd(['git', 'fetch', '--prune', 'origin'] + self.clone_args, cwd=git_dir, quiet=quiet,
+                               timeout=self.git_timeout)
+        return ret
+
+    def git_pull_module(self, git_dir, version=None, quiet=False):
+        """like git_pull, but keeps blobless/shallow clones (clone_mode) pinned to their release branch"""
+        if self.clone_mode == 'full':
+            return self.git_pull(git_dir, version, quiet)
+        branch = version or self.module_branch(git_dir)
+        ret = self.git_fetch_module(git_dir, version, quiet)
+        if not ret and version:
+            ret = self.run_cmd(['git', 'checkout', version], cwd=git_dir, quiet=quiet)
+        if not ret:
+            # shallow history has no common ancestor to merge with, local changes are kept
+            ret = self.run_cmd(['git', 'reset', '--keep', 'origin/' + branch], cwd=git_dir, quiet=quiet)
+        return ret
+
+    def git_maintenance(self):
+        """runs gc and writes the commit-graph of the extension and skin repositories and their submodules,
+        returns the number of failed repositories"""
+        self.step('Git maintenance')
+        commands = [['git', 'gc', '--quiet'], ['git', 'commit-graph', 'write', '--reachable']]
+        if self.clone_mode == 'shallow':
+            # drop the history which is only reachable from the reflog after a shallow fetch
+            commands = [['git', 'reflog', 'expire', '--expire=now', '--all'],
+                        ['git', 'gc', '--quiet', '--prune=now'], commands[1]]
+        commands.append(['git', 'submodule', '--quiet', 'foreach', '--recursive',
+                         ' && '.join(' '.join(cmd) for cmd in commands)])
+
+        def maintain(subdir):
+            git_dir = self.wiki_dir + subdir + '/'
+            size = self.git_object_size(git_dir)
+            branch = self.module_branch(git_dir)
+            if self.clone_mode != 'full' and branch and self.pin_clone(git_dir, branch):
+                return 'git config failed'
+            for cmd in commands:
+                if self.run_cmd(cmd, cwd=git_dir, quiet=True):
+                    return ' '.join(cmd[:2]) + ' failed'
+            return f'{size / (1 << 20):.1f} MiB -> {self.git_object_size(git_dir) / (1 << 20):.1f} MiB'
+
+        subdirs = [subdir for _, subdir in self.git_modules()]
+        with ThreadPoolExecutor(max_workers=max(1, self.check_concurrency)) as pool:
+            results = list(pool.map(maintain, subdirs))
+        for subdir, result in zip(subdirs, results):
+            if result.endswith('failed'):
+                self.warn('git maintenance of ' + subdir + ': ' + result)
+            else:
+                self.info(subdir, result)
+        return sum(result.endswith('failed') for result in results)
 
-    def update_git_module(self, subdir, version):
+    def git_each(self, args, subdirs):
+        """runs args in the given repositories relative to work_dir concurrently and returns their outputs"""
+        commands = [{'args': args, 'cwd': self.work_dir + subdir, 'capture': True, 'quiet': True} for subdir in subdirs]
+        return [res.stdout for res in self.runner.call(self.runner.run_many(commands, self.check_concurrency))]
+
+    def local_heads(self, subdirs):
+        """returns the HEAD commits of the given repositories relative to work_dir, read concurrently"""
+        return self.git_each(['git', 'rev-parse', '@'], subdirs)
+
+    def check_git_module_update(self, subdir, version=None):
+        """returns (True if new commits are available, False if up-to-date and None on error, remote commit)"""
         git_dir = self.wiki_dir + subdir + '/'
 
-        if version:
-            upgrade_cmd = 'git pull && git checkout '+version
+        if self.check_mode == 'ls-remote':
+            remote = self.remote_head(git_dir, version)
+        # only fetch, the working tree is updated by the upgrade
+        elif self.git_fetch_module(git_dir, version, quiet=True):
+            remote = None
         else:
-            upgrade_cmd = 'git pull'
-
-        ret = self.run_cmd(upgrade_cmd, cwd=git_dir)
+            remote = self.get_cmd(['git', 'rev-parse', 'origin/' + version if version else '@{u}'], cwd=git_dir)[0]
+        if not remote:
+            return (None, None)
+        return (self.get_cmd(['git', 'rev-parse', '@'], cwd=git_dir)[0] != remote, remote)
+
+    def git_modules(self):
+        return [('extension', 'extensions/' + ext) for ext in self.extensions_git] + \
+               [('skin', 'skins/' + skin) for skin in self.skins_git]
+
+    def check_git_modules(self, modules, version=None):
+        """checks the given (kind, subdir) modules concurrently, results are in the order of modules"""
+        with ThreadPoolExecutor(max_workers=max(1, self.check_concurrency)) as pool:
+            return list(pool.map(lambda module: self.check_git_module_update(module[1], version), modules))
+
+    def git_fetch_commit(self, git_dir, sha, args, quiet=False):
+        """fetches the commit sha with the fetch arguments args unless git_dir has it, returns the return code"""
+        if not self.exec_cmd(['git', 'cat-file', '-e', sha + '^{commit}'], cwd=git_dir, capture=True,
+                             quiet=True).returncode:
+            return 0
+        # e.g. a shallow fetch only got a newer tip of the branch or git maintenance pruned an old one
+        return self.run_cmd(['git', 'fetch', 'origin', sha] + args, cwd=git_dir, quiet=quiet, timeout=self.git_timeout)
+
+    def git_forward(self, git_dir, target, ff_only=False, quiet=False):
+        """moves the checked out branch in git_dir to the fetched commit target, returns the return code
+
+        Full clones merge target like git pull did (only fast-forwards with ff_only), blobless and shallow clones
+        reset to it, keeping local changes.
+        """
+        ret = self.git_fetch_commit(git_dir, target, [] if self.clone_mode == 'full' else self.clone_args, quiet)
+        if ret:
+            return ret
+        if self.clone_mode == 'full' or ff_only:
+            return self.run_cmd(['git', 'merge', '--ff-only' if ff_only else '--no-edit', target], cwd=git_dir,
+                                quiet=quiet)
+        return self.run_cmd(['git', 'reset', '--keep', target], cwd=git_dir, quiet=quiet)
+
+    def update_git_module(self, subdir, version, target=None):
+        """updates the module to the commit target (from the check) or pulls version/its upstream branch"""
+        git_dir = self.work_dir + subdir + '/'
+
+        size = self.git_object_size(git_dir)
+        if target and not version:
+            ret = self.git_fetch_module(git_dir) or self.git_forward(git_dir, target)
+        else:
+            ret = self.git_pull_module(git_dir, version)
+        self.report.add_bytes('git', max(0, self.git_object_size(git_dir) - size))
         if ret:
             self.warn('git pull failed for ' + subdir)
             return ret
-        ret = self.run_cmd('git submodule update --init --recursive', cwd=git_dir)
+        cmd = ['git', 'submodule', 'update', '--init', '--recursive']
+        ret = self.run_cmd(cmd + self.clone_args, cwd=git_dir, timeout=self.git_timeout)
+        if ret and self.clone_args:
+            # e.g. the recorded commit is not the tip of a branch, which a shallow fetch cannot get
+            ret = self.run_cmd(cmd, cwd=git_dir, timeout=self.git_timeout)
         if ret:
             self.warn('failed to update submodules')
         return ret
 
-    def update_extensions_git(self, version=None):
+    def update_modules_git(self, kind, version=None):
+        """updates the git modules of the given kind (extension or skin) which are marked in the plan"""
         error = 0
-        for ext in self.extensions_git:
-            self.info('Updating ' + ext)
-            ret = self.update_git_module('extensions/' + ext, version)
+        for module in self.plan['modules']:
+            if module['type'] != kind:
+                continue
+            name = module['path'].split('/', 1)[1]
+            if not module['update']:
+                self.info('Up-to-date: ' + name)
+                continue
+            self.info('Updating ' + name)
+            ret = self.update_git_module(module['path'], version, module['target'])
             if ret:
                 error = 1
         return error
 
-    def update_skins_git(self, version=None):
-        error = 0
-        for skin in self.skins_git:
-            self.info('Updating ' + skin)
-            ret = self.update_git_module('skins/' + skin, version)
-            if ret:
-                error = 1
-        return error
+    def new_plan(self, version=None):
+        """returns a plan without actions, version is the new branch for major upgrades"""
+        return {
+            'created': time.time(),
+            'version': version,
+            # {'type', 'path', 'local', 'target', 'update'}, local is the HEAD the plan was made for
+            'core': None,
+            'modules': [],
+            # None: only if the composer manifests changed, see update_composer
+            'composer': None,
+            # None: only if the pulled commits contain schema changes, see check_update_php
+            'update_php': True if version else None,
+        }
+
+    def plan_major_upgrade(self, version):
+        plan = self.new_plan(version)
+        modules = self.git_modules()
+        heads = self.local_heads([''] + [subdir for _, subdir in modules])
+        plan['core'] = {'type': 'core', 'path': '', 'local': heads[0], 'target': version, 'update': True}
+        for (kind, subdir), head in zip(modules, heads[1:]):
+            plan['modules'].append({'type': kind, 'path': subdir, 'target': version, 'update': True, 'local': head})
+        return plan
+
+    def print_plan(self):
+        plan = self.plan
+        rows = [('TYPE', 'MODULE', 'ACTION')]
+        for module in [plan['core']] + plan['modules']:
+            name = module['path'].split('/', 1)[-1] or 'mediawiki'
+            if not module['update']:
+                action = 'none'
+            elif plan['version']:
+                action = 'checkout ' + plan['version']
+            else:
+                action = 'update ' + module['local'][:8] + ' -> ' + (module['target'] or 'upstream')[:8]
+            rows.append((module['type'], name, action))
+        composer = {True: 'update', False: 'none', None: 'update if manifests changed'}[plan['composer']]
+        rows.append(('composer', '', composer))
+        update_php = {True: 'run', False: 'none', None: 'run if schema changed'}[plan['update_php']]
+        rows.append(('update.php', '', 'run' if self.force_update_php else update_php))
+        self.table(rows)
+
+    def write_plan(self, major=False, version=None):
+        """checks for updates and saves the resulting plan, returns the exit code"""
+        ret = 0
+        if major:
+            if version and version not in self.get_branches():
+                self.fail(f'Version {version} does not exist')
+            if not version and self.check_major_upgrade():
+                version = self.get_newest_version()
+            need_update = version is not None
+            if need_update:
+                self.plan = self.plan_major_upgrade(version)
+        else:
+            if self.check_major_upgrade():
+                print('new major version available!')
+                ret = 2
+            need_update = self.check_minor_upgrade()
+
+        self.step('Writing plan')
+        if not need_update:
+            if os.path.exists(self.plan_file):
+                os.remove(self.plan_file)
+            self.log('Nothing to do')
+            return ret
+        self.print_plan()
+        os.makedirs(self.state_dir, exist_ok=True)
+        with open(self.plan_file + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(self.plan, f, indent=2)
+        os.replace(self.plan_file + '.tmp', self.plan_file)
+        self.info('plan written to', self.plan_file)
+        return ret
+
+    def apply_plan(self):
+        """performs the upgrade from the saved plan without checking for updates again"""
+        self.step('Loading plan')
+        try:
+            with open(self.plan_file, encoding='utf-8') as f:
+                plan = json.load(f)
+        except (OSError, ValueError) as ex:
+            self.fail('could not load plan: ' + str(ex))
+        modules = [plan['core']] + plan['modules']
+        for module, local in zip(modules, self.local_heads([module['path'] for module in modules])):
+            if local != module['local']:
+                self.fail('plan is stale, ' + (module['path'] or 'mediawiki') + ' is at ' + local +
+                          ' instead of ' + module['local'] + ' (run --plan again)')
+        self.plan = plan
+        self.print_plan()
+        # a plan is only applied once
+        os.remove(self.plan_file)
+        self.upgrade(plan['version'])
 
     def check_minor_upgrade(self):
         need_update = False
+        self.plan = self.new_plan()
 
         log = self.log
         info = self.info
@@ -266,14 +1289,20 @@ class MediaWikiUpdater:
         run_cmd = self.run_cmd
 
         step('Checking for mediawiki update')
-        ret = run_cmd('git remote update')
-        if ret:
-            fail('could not update get remote')
-        local = get_cmd('git rev-parse @')[0]
+        if self.check_mode == 'ls-remote':
+            remote = self.remote_head(self.wiki_dir)
+            if remote is None:
+                fail('could not get remote refs')
+        else:
+            ret = run_cmd(['git', 'remote', 'update'], timeout=self.git_timeout)
+            if ret:
+                fail('could not update get remote')
+            remote = get_cmd(['git', 'rev-parse', '@{u}'])[0]
+        local = get_cmd(['git', 'rev-parse', '@'])[0]
         info('local', local)
-        remote = get_cmd('git rev-parse @{u}')[0]
         info('remote', remote)
-        base = get_cmd('git merge-base @ @{u}')[0]
+        # in ls-remote mode @{u} is the last fetched state, which is sufficient to detect local commits
+        base = get_cmd(['git', 'merge-base', '@', '@{u}'])[0]
         info('base', base)
         if local == remote:
             log('Up-to-date')
@@ -281,127 +1310,558 @@ class MediaWikiUpdater:
             fail('Branch was modified. Can not pull!')
         else:
             need_update = True
-
-        # step('Checking for Composer updates')
-        # ret = get_cmd('https_proxy=' + self.proxy + ' http_proxy=' + self.proxy +
-        #               ' composer update --no-dev --dry-run --no-progress --no-suggest -n --no-ansi')
-        # ret = re.findall(
-        #    '([0-9]+) install[s]?, ([0-9]+) update[s]?, ([0-9]+) removal[s]?', ret[1])
-        # if ret:
-        #     composer_changes = int(ret[0][1]) + int(ret[0][2])
-        #     if composer_changes > 1:
-        #         info(str(composer_changes) + ' composer changes')
-        #         need_update = True
-
-        step('Checking for extension update')
-        for ext in self.extensions_git:
-            has_updates = self.check_git_module_update('extensions/' + ext)
-            if has_updates:
-                info('New commits available for extension: ' + ext)
-                need_update = True
-            else:
-                info('Up-to-date: ' + ext)
-
-        step('Checking for skin update')
-        for skin in self.skins_git:
-            has_updates = self.check_git_module_update('skins/' + skin)
-            if has_updates:
-                info('New commits available for skin: ' + skin)
+        self.plan['core'] = {'type': 'core', 'path': '', 'local': local, 'target': remote, 'update': need_update}
+
+        step('Checking for extension and skin updates')
+        modules = self.git_modules()
+        heads = self.local_heads([subdir for _, subdir in modules])
+        rows = [('TYPE', 'MODULE', 'STATUS')]
+        for (kind, subdir), head, (has_updates, remote) in zip(modules, heads, self.check_git_modules(modules)):
+            name = subdir.split('/', 1)[1]
+            if has_updates is None:
+                self.warn('git pull failed for ' + subdir + '. Skipping...')
+                status = 'failed'
+            elif has_updates:
                 need_update = True
+                status = 'new commits'
             else:
-                info('Up-to-date: ' + skin)
+                status = 'up-to-date'
+            rows.append((kind, name, status))
+            # modules which could not be checked are updated anyway (to their upstream branch)
+            self.plan['modules'].append({'type': kind, 'path': subdir, 'target': remote,
+                                         'update': has_updates is not False, 'local': head})
+        self.table(rows)
 
         if not need_update:
             self.log('Up-to-date')
         return need_update
 
-    def do_minor_upgrade(self):
-        do_upgrade = self.check_minor_upgrade()
-        if not do_upgrade:
-            return
+    def php_service_ctl(self, action):
+        step_msg = {'stop': 'Stop PHP Service', 'start': 'Start PHP Service', 'reload': 'Reload PHP Service'}
+        if action == 'stop':
+            self.report.set_service_down(True)
+        self.step(step_msg[action])
+        ret = self.run_cmd(self.service_cmd + [action, self.php_service])
+        if ret:
+            self.fail('Failed to ' + action + ' PHP Service')
+        if action == 'start':
+            self.report.set_service_down(False)
 
+    def update_code(self, version=None):
+        """updates core, submodules, extensions and skins in work_dir, version is the new branch for major upgrades"""
         info = self.info
         step = self.step
         fail = self.fail
-        success = self.success
         run_cmd = self.run_cmd
-        get_cmd = self.get_cmd
 
-        info('Updates available. Proceeding...\n')
+        info('Updating ' + self.work_dir)
+        size = self.git_object_size(self.work_dir)
+        if version:
+            step('Checkout new mediawiki branch')
+            ret = self.git_pull(version=version)
+            if ret:
+                fail('git pull && git checkout ' + version + ' failed!')
+        elif self.plan['core']['update']:
+            step('Pulling new commits')
+            # exactly the commit found by the check
+            ret = run_cmd(['git', 'fetch', 'origin'], timeout=self.git_timeout) or \
+                self.git_forward(self.work_dir, self.plan['core']['target'], ff_only=True)
+            if ret:
+                fail('git fetch && git merge --ff-only ' + self.plan['core']['target'] + ' failed')
+        self.report.add_bytes('git', max(0, self.git_object_size(self.work_dir) - size))
 
-        step('Checking wiki dir')
-        ret = get_cmd('git status --porcelain --ignore-submodules=all -uno')[0]
-        if ret != '':
-            fail('Can not update. Wiki dir has changes! (run git status -uno)')
+        if version or self.plan['core']['update']:
+            step('Updating Submodules')
+            ret = run_cmd(['git', 'submodule', 'update', '--init', '--recursive'], timeout=self.git_timeout)
+            if ret:
+                # asking nicely didn't work...
+                ret = run_cmd(['git', 'submodule', 'update', '--init', '--recursive', '--force'],
+                              timeout=self.git_timeout)
+            if ret:
+                fail('git submodule update failed')
+        else:
+            info('Up-to-date: mediawiki')
 
-        step('Stop PHP Service')
-        ret = run_cmd('sudo /bin/systemctl stop ' + self.php_service)
+        step('Updating Extensions (git)')
+        ret = self.update_modules_git('extension', version)
         if ret:
-            fail('Failed to stop PHP Service')
+            fail('updating extensions failed')
 
-        step('Backing up Database')
-        ret = self.backup_db()
+        step('Updating Skins (git)')
+        ret = self.update_modules_git('skin', version)
         if ret:
-            fail('Database Backup failed')
+            fail('updating skins failed')
 
-        step('Backing up Files (without uploads)')
-        ret = self.backup_files_borg()
-        if ret:
-            fail('Files Backup failed')
+        # after the extensions, composer.local.json merges their composer.json
+        step('Updating Extensions (Composer)')
+        self.update_composer()
+
+    def composer_fingerprint(self, root=None):
+        """returns a hash of composer.json, composer.local.json and the composer.json of all extensions and skins"""
+        root = root or self.work_dir
+        names = ['composer.json', 'composer.local.json']
+        names += sorted(os.path.relpath(path, root) for path in
+                        glob.glob(root + 'extensions/*/composer.json') + glob.glob(root + 'skins/*/composer.json'))
+        fingerprint = hashlib.sha256()
+        for name in names:
+            try:
+                with open(root + name, 'rb') as f:
+                    data = f.read()
+            except FileNotFoundError:
+                continue
+            fingerprint.update(name.encode('utf-8') + b'\0' + hashlib.sha256(data).digest())
+        return fingerprint.hexdigest()
+
+    def vendor_fingerprint(self, root=None):
+        """returns the fingerprint the vendor dir in root was installed for or None"""
+        try:
+            with open((root or self.work_dir) + 'vendor/.fingerprint', encoding='utf-8') as f:
+                return f.read().strip()
+        except OSError:
+            return None
 
-        ret = self.borg_prune()
+    @staticmethod
+    def copy_vendor(src, dst):
+        """replaces vendor/ and composer.lock in dst by a copy of those in src"""
+        shutil.rmtree(dst + 'vendor.tmp', ignore_errors=True)
+        shutil.copytree(src + 'vendor', dst + 'vendor.tmp', symlinks=True)
+        if os.path.exists(src + 'composer.lock'):
+            shutil.copy2(src + 'composer.lock', dst + 'composer.lock')
+        if os.path.exists(dst + 'vendor'):
+            os.replace(dst + 'vendor', dst + 'vendor.old')
+        os.replace(dst + 'vendor.tmp', dst + 'vendor')
+        shutil.rmtree(dst + 'vendor.old', ignore_errors=True)
+
+    def update_composer(self):
+        """runs composer update unless vendor/ was installed for the current manifests or is in the vendor cache"""
+        fingerprint = self.composer_fingerprint()
+        if self.plan['composer'] is None and self.vendor_fingerprint() == fingerprint:
+            self.log('Composer manifests unchanged')
+            return
+        cached = self.vendor_cache_dir + fingerprint + '/'
+        if self.plan['composer'] is None and os.path.isdir(cached + 'vendor'):
+            self.info('restoring vendor from', cached)
+            try:
+                self.copy_vendor(cached, self.work_dir)
+                os.utime(cached)
+                return
+            except OSError as ex:
+                self.warn('could not restore vendor: ' + str(ex))
+
+        if not self.staged:
+            # composer changes vendor in place, the old one is needed to roll back
+            self.cache_vendor(step=False)
+        ret = self.run_cmd(['composer', 'update', '--no-dev', '-o', '--apcu-autoloader', '--no-progress',
+                            '--no-suggest', '-n', '--no-ansi'], env=self.composer_env())
         if ret:
-            fail('Pruning failed')
+            self.fail('composer update failed')
+        os.makedirs(self.work_dir + 'vendor', exist_ok=True)
+        with open(self.work_dir + 'vendor/.fingerprint', 'w', encoding='utf-8') as f:
+            f.write(fingerprint + '\n')
+        self.plan['composer'] = True
+
+    def cache_vendor(self, step=True):
+        """copies vendor/ of work_dir to the vendor cache and removes all but the newest vendor_cache_keep entries"""
+        fingerprint = self.vendor_fingerprint()
+        if not fingerprint or self.vendor_cache_keep <= 0:
+            return
+        cached = self.vendor_cache_dir + fingerprint
+        if step:
+            self.step('Caching vendor')
+        try:
+            if not os.path.isdir(cached):
+                shutil.rmtree(cached + '.tmp', ignore_errors=True)
+                os.makedirs(cached + '.tmp')
+                self.copy_vendor(self.work_dir, cached + '.tmp/')
+                os.replace(cached + '.tmp', cached)
+            os.utime(cached)
+            entries = [self.vendor_cache_dir + name for name in os.listdir(self.vendor_cache_dir)]
+            entries.sort(key=os.path.getmtime, reverse=True)
+            for entry in entries[self.vendor_cache_keep:]:
+                shutil.rmtree(entry, ignore_errors=True)
+        except OSError as ex:
+            self.warn('could not cache vendor: ' + str(ex))
+
+    def schema_changes(self, git_dir, old, new):
+        """returns the files changed between the commits old and new in git_dir and its submodules which
+        require update.php"""
+        res = self.exec_cmd(['git', 'diff', '--raw', '--no-abbrev', '--no-renames', old, new], cwd=git_dir,
+                            capture=True, quiet=True)
+        if res.returncode:
+            # e.g. old is not available anymore, better run update.php once too often
+            return ['(no diff ' + old[:8] + '..' + new[:8] + ')']
+        changed = []
+        for line in res.stdout.splitlines():
+            meta, path = line.split('\t', 1)
+            old_mode, new_mode, old_sha, new_sha = meta.lstrip(':').split()[:4]
+            if old_mode == new_mode == '160000':
+                changed += [path + '/' + sub for sub in self.schema_changes(git_dir + path + '/', old_sha, new_sha)]
+            elif new_mode == '160000' or SCHEMA_FILES.search(path):
+                changed.append(path)
+            elif os.path.basename(path) in ('extension.json', 'skin.json'):
+                diff = self.get_cmd(['git', 'diff', '-U0', old, new, '--', path], cwd=git_dir)[0]
+                if any(SCHEMA_HOOKS.search(line) and '$schema' not in line
+                       for line in diff.splitlines() if line[:1] in '+-' and line[:3] not in ('+++', '---')):
+                    changed.append(path)
+        return changed
+
+    def check_update_php(self):
+        """decides if update.php has to run by looking for schema changes in the pulled commits"""
+        if self.force_update_php:
+            self.plan['update_php'] = True
+        if self.plan['update_php'] is not None:
+            return
+        self.step('Checking for schema changes')
+        # every module whose HEAD moved, whether the check saw new commits or not
+        modules = [self.plan['core']] + self.plan['modules']
+        changed = []
+        for module, head in zip(modules, self.local_heads([module['path'] for module in modules])):
+            if head and head != module['local']:
+                prefix = module['path'] + '/' if module['path'] else ''
+                changed += [prefix + path for path in
+                            self.schema_changes(self.work_dir + prefix, module['local'], head)]
+        if changed:
+            self.info('schema changes', ', '.join(changed[:10]) + (' ...' if len(changed) > 10 else ''))
+        else:
+            self.log('No schema changes, skipping update.php')
+        self.plan['update_php'] = bool(changed)
 
-        step('Pulling new commits')
-        ret = run_cmd('git pull')
+    def run_update_php(self):
+        if not self.plan['update_php']:
+            return
+        self.step('Run update.php')
+        ret = self.run_cmd(['php', 'update.php', '--quick'], cwd=self.work_dir + 'maintenance/', timeout=None)
         if ret:
-            fail('git pull failed')
+            self.fail('update.php failed')
+
+    def stage_dir(self):
+        """returns the stage dir which is currently not served by wiki_dir"""
+        link = self.wiki_dir.rstrip('/')
+        if not os.path.islink(link):
+            self.fail(link + ' must be a symlink to one of ' + ', '.join(self.stage_dirs) + ' for staged upgrades')
+        live = os.path.realpath(link)
+        stage_dirs = [d for d in self.stage_dirs if os.path.realpath(d) != live]
+        if len(stage_dirs) != len(self.stage_dirs) - 1:
+            self.fail(link + ' does not point to one of ' + ', '.join(self.stage_dirs))
+        return stage_dirs[0]
+
+    def switch_wiki_dir(self, target):
+        """atomically points the wiki_dir symlink to target"""
+        link = self.wiki_dir.rstrip('/')
+        self.info('Switching ' + link + ' to ' + target)
+        tmp = link + '.tmp'
+        if os.path.lexists(tmp):
+            os.remove(tmp)
+        os.symlink(target.rstrip('/'), tmp)
+        os.replace(tmp, link)
+
+    def db_dump_path(self):
+        """returns the local database dump of the last backup or None if it is only in borg"""
+        if self.db_backup_mode == 'stream':
+            return None
+        return self.db_dump_dir + ('tables/' if self.db_backup_mode == 'tables' else 'db_dump.sql')
+
+    def save_rollback(self):
+        """records the commits, branches and vendor of the live tree, so a failed upgrade can be rolled back"""
+        subdirs = [''] + [subdir for _, subdir in self.git_modules()]
+        heads = self.local_heads(subdirs)
+        branches = self.git_each(['git', 'rev-parse', '--abbrev-ref', 'HEAD'], subdirs)
+        rollback = {
+            'created': time.time(),
+            'live': os.path.realpath(self.wiki_dir) + '/' if self.staged else None,
+            'repos': [{'path': subdir, 'head': head, 'branch': branch}
+                      for subdir, head, branch in zip(subdirs, heads, branches)],
+            'vendor': self.vendor_fingerprint(),
+            'db_dump': self.db_dump_path(),
+        }
+        os.makedirs(self.state_dir, exist_ok=True)
+        with open(self.rollback_file + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(rollback, f, indent=2)
+        os.replace(self.rollback_file + '.tmp', self.rollback_file)
+
+    def rollback_repo(self, repo):
+        """checks out the recorded branch and commit of a repository, returns an error message or None"""
+        git_dir = self.wiki_dir + repo['path']
+        if repo['branch'] != 'HEAD':
+            if self.run_cmd(['git', 'checkout', '-q', repo['branch']], cwd=git_dir, quiet=True):
+                return 'git checkout ' + repo['branch'] + ' failed'
+            if repo['path'] and self.clone_mode != 'full':
+                self.pin_clone(git_dir, repo['branch'])
+        if self.git_fetch_commit(git_dir, repo['head'], self.clone_args if repo['path'] else [], quiet=True):
+            return 'git fetch of ' + repo['head'][:8] + ' failed'
+        if self.run_cmd(['git', 'reset', '-q', '--keep', repo['head']], cwd=git_dir, quiet=True):
+            return 'git reset to ' + repo['head'][:8] + ' failed'
+        if self.run_cmd(['git', 'submodule', 'update', '--init', '--recursive', '--force'], cwd=git_dir, quiet=True):
+            return 'git submodule update failed'
+        return None
+
+    def restore_db_dump(self, path):
+        """loads the dump file or the dumped tables in path into the database, returns the return code"""
+        mysql_cmd = ['mysql', '-u', self.db_user, '--password=' + self.db_pass, self.db_name]
+        if not path.endswith('/'):
+            return self.pipe_cmd(['cat', path], mysql_cmd, timeout=None)[0]
+        for name in sorted(os.listdir(path)):
+            if name.endswith('.sql.gz'):
+                ret = self.pipe_cmd(['gzip', '-dc', path + name], mysql_cmd, timeout=None)[0]
+                if ret:
+                    return ret
+        return 0
+
+    def rollback(self, restore_db=False):
+        """returns the wiki to the state recorded by save_rollback and verifies it, returns an error message or None
+
+        Staged upgrades switch back to the untouched old tree, otherwise all repositories are reset and vendor
+        is restored from the vendor cache. The database is only restored with restore_db.
+        """
+        self.step('Rolling back')
+        try:
+            with open(self.rollback_file, encoding='utf-8') as f:
+                rollback = json.load(f)
+        except (OSError, ValueError) as ex:
+            return 'could not load rollback state: ' + str(ex)
+        self.work_dir = self.wiki_dir
+        if restore_db and not rollback['db_dump']:
+            # before touching the code, old code must not run on a migrated schema
+            return 'no local database dump (db_backup_mode=stream), restore it from borg'
+        if restore_db:
+            # neither the old code on the migrated schema nor the new code on the restored one may serve requests,
+            # php stays stopped if the rollback fails
+            self.php_service_ctl('stop')
+
+        if rollback['live']:
+            self.switch_wiki_dir(rollback['live'])
+        else:
+            with ThreadPoolExecutor(max_workers=max(1, self.check_concurrency)) as pool:
+                errors = list(pool.map(self.rollback_repo, rollback['repos']))
+            for repo, err in zip(rollback['repos'], errors):
+                if err:
+                    self.warn((repo['path'] or 'mediawiki') + ': ' + err)
+            if any(errors):
+                return 'could not roll back all repositories'
+            cached = self.vendor_cache_dir + str(rollback['vendor']) + '/'
+            if rollback['vendor'] and self.vendor_fingerprint() != rollback['vendor']:
+                if not os.path.isdir(cached + 'vendor'):
+                    return 'vendor ' + rollback['vendor'][:12] + ' is not in the vendor cache'
+                self.info('restoring vendor from', cached)
+                self.copy_vendor(cached, self.wiki_dir)
+
+        if restore_db:
+            self.step('Restoring Database')
+            self.info('restoring', rollback['db_dump'])
+            if self.restore_db_dump(rollback['db_dump']):
+                return 'restoring the database failed'
+            self.php_service_ctl('start')
+        else:
+            self.php_service_ctl('reload')
+        err, broken = self.verify()
+        if err and not broken:
+            # e.g. slow with cold caches, but working
+            self.warn(err)
+        return err if broken else None
+
+    def do_rollback(self):
+        """rolls back the last upgrade on request"""
+        err = self.rollback(self.restore_db)
+        if err:
+            self.fail('Rollback failed: ' + err)
+        os.remove(self.rollback_file)
+        self.success('Rolled back.', 1)
+
+    def wait_ready(self):
+        """polls check_url until it returns 200 or ready_timeout passed, returns the last status code"""
+        deadline = time.monotonic() + self.ready_timeout
+        while True:
+            try:
+                status = requests.get(self.check_url, timeout=10).status_code
+            except requests.RequestException:
+                status = None
+            if status == 200 or time.monotonic() > deadline:
+                return status
+            time.sleep(0.5)
+
+    def warmup_urls(self, session):
+        """returns the set of urls of the configured pages and all urls, the configured pages followed by the most
+        viewed pages"""
+        urls = [self.warmup_base + urllib.parse.quote(page.strip().replace(' ', '_')) for page in self.warmup_pages]
+        configured = set(urls)
+        if self.warmup_top_n > 0:
+            try:
+                res = session.get(self.warmup_api, timeout=10, params={
+                    'action': 'query', 'list': 'mostviewed', 'pvimlimit': self.warmup_top_n, 'format': 'json'}).json()
+                urls += [self.warmup_base + urllib.parse.quote(page['title'].replace(' ', '_'))
+                         for page in res['query']['mostviewed']]
+            except (requests.RequestException, ValueError, KeyError) as ex:
+                self.warn('could not get most viewed pages: ' + str(ex))
+        return (configured, list(dict.fromkeys(urls)))
 
-        step('Updating Submodules')
-        ret = run_cmd('git submodule update --init --recursive')
-        if ret:
-            # asking nicely didn't work...
-            ret = run_cmd('git submodule update --init --recursive --force')
-        if ret:
-            fail('git submodule update failed')
+    @staticmethod
+    def percentile(values, p):
+        values = sorted(values)
+        return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+    def warmup(self):
+        """fetches the warm-up pages concurrently, returns (error message or None, broken)
+
+        broken is only set if one of the configured pages failed, slow or failing most viewed pages are errors too
+        """
+        with requests.Session() as session:
+            adapter = requests.adapters.HTTPAdapter(pool_maxsize=self.warmup_concurrency)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            configured, urls = self.warmup_urls(session)
+            if not urls:
+                return (None, False)
+
+            def fetch(url):
+                start = time.monotonic()
+                try:
+                    status = session.get(url, timeout=60).status_code
+                except requests.RequestException:
+                    status = None
+                return (status, time.monotonic() - start)
+
+            with ThreadPoolExecutor(max_workers=max(1, self.warmup_concurrency)) as pool:
+                results = list(pool.map(fetch, urls))
+
+        rows = [('PAGE', 'STATUS', 'SECONDS')]
+        for url, (status, seconds) in zip(urls, results):
+            rows.append((urllib.parse.unquote(url[len(self.warmup_base):]), str(status), f'{seconds:.2f}'))
+        self.table(rows)
+
+        latencies = [seconds for _, seconds in results]
+        p50 = self.percentile(latencies, 50)
+        p95 = self.percentile(latencies, 95)
+        self.info('latency', f'p50 {p50:.2f}s, p95 {p95:.2f}s')
+        self.report.values['warmup_p50_seconds'] = round(p50, 3)
+        self.report.values['warmup_p95_seconds'] = round(p95, 3)
+
+        errors = [url for url, (status, _) in zip(urls, results) if status is None or status >= 500]
+        if errors:
+            return ('Warm-up failed for ' + ', '.join(errors), any(url in configured for url in errors))
+        if self.warmup_max_p95 and p95 > self.warmup_max_p95:
+            return (f'p95 latency {p95:.2f}s exceeds {self.warmup_max_p95:.2f}s', False)
+
+        baseline_file = self.state_dir + 'warmup.json'
+        try:
+            with open(baseline_file, encoding='utf-8') as f:
+                baseline = json.load(f)['p95']
+        except (OSError, ValueError, KeyError):
+            baseline = None
+        if baseline and self.warmup_max_regression and p95 > baseline * self.warmup_max_regression:
+            return (f'p95 latency {p95:.2f}s regressed from {baseline:.2f}s', False)
+        try:
+            UpgradeReport.write_file(baseline_file, json.dumps({'p50': p50, 'p95': p95}))
+        except OSError as ex:
+            self.warn('could not save warm-up latencies: ' + str(ex))
+        return (None, False)
+
+    def verify(self):
+        """waits for the wiki to come up and warms up its caches, returns (error message or None, broken)
+
+        Only a wiki which does not come up or fails on one of the configured warm-up pages is broken and worth a
+        rollback, latency regressions and failing most viewed pages are reported as errors only.
+        """
+        self.step('Making test request')
+        status = self.wait_ready()
+        if status != 200:
+            return ('Check URL returned status code ' + str(status), True)
+
+        self.step('Warming up caches')
+        return self.warmup()
+
+    def upgrade(self, version=None):
+        """performs the upgrade, version is the new branch for major upgrades"""
+        step = self.step
+        fail = self.fail
 
-        # step('Updating Extensions (Composer)')
-        # ret = run_cmd('https_proxy=' + self.proxy + ' http_proxy=' + self.proxy +
-        #               ' COMPOSER_HOME=' + self.composer_home +
-        #               ' composer update --no-dev -o --apcu-autoloader --no-progress --no-suggest -n --no-ansi')
-        # if ret:
-        #     fail('composer update failed')
+        step('Checking wiki dir')
+        ret = self.get_cmd(['git', 'status', '--porcelain', '--ignore-submodules=all', '-uno'])[0]
+        if ret != '':
+            fail('Can not update. Wiki dir has changes! (run git status -uno)')
 
-        step('Updating Extensions (git)')
-        ret = self.update_extensions_git()
-        if ret:
-            fail('updating extensions failed')
+        files_msg = 'Files (with uploads)' if version else 'Files (without uploads)'
+
+        if not self.staged:
+            # wait for a running maintenance before the service goes down
+            with self.borg_lock():
+                if self.backup_prephase:
+                    step('Backing up Files (pre-phase)')
+                    if self.backup_files_pre():
+                        # only an optimization, the real backup follows
+                        self.warn('pre-phase backup failed')
+                self.php_service_ctl('stop')
+                self.backup(files_msg)
+
+            self.save_rollback()
+            self.update_code(version)
+            self.check_update_php()
+            self.run_update_php()
+
+            self.php_service_ctl('start')
+        else:
+            # the current tree keeps serving while the new one is prepared
+            stage = self.stage_dir()
 
-        step('Updating Skins (git)')
-        ret = self.update_skins_git()
-        if ret:
-            fail('updating skins failed')
+            with self.borg_lock():
+                self.backup(files_msg)
 
-        step('Run update.php')
-        ret = run_cmd('php update.php --quick', cwd=self.wiki_dir + 'maintenance/')
-        if ret:
-            fail('update.php failed')
+            self.save_rollback()
+            step('Preparing staged tree')
+            live = os.path.realpath(self.wiki_dir)
+            self.info('rsync ' + live + '/ ' + stage)
+            ret = self.run_cmd(['rsync', '-a', '--delete', live + '/', stage])
+            if ret:
+                fail('Preparing ' + stage + ' failed')
+            self.work_dir = stage
+
+            self.update_code(version)
+            self.check_update_php()
+
+            if self.plan['update_php']:
+                # only the schema update and the switch happen while the service is down
+                self.php_service_ctl('stop')
+                self.run_update_php()
+                self.switch_wiki_dir(stage)
+                self.php_service_ctl('start')
+            else:
+                # without schema changes the new code is switched to without any downtime
+                self.switch_wiki_dir(stage)
+                self.php_service_ctl('reload')
+
+        err, broken = self.verify()
+        if broken and self.auto_rollback:
+            self.warn(err)
+            # the schema of the database only changed if update.php ran, the old code needs the old schema
+            if self.plan['update_php'] and not self.restore_db:
+                fail(err + ', not rolled back as update.php changed the database (rollback_restore_db=no), '
+                     'roll back with --rollback --restore-db')
+            rollback_err = self.rollback(bool(self.plan['update_php']))
+            if rollback_err:
+                fail(err + ', rollback failed: ' + rollback_err)
+            fail(err + ', rolled back')
+        if err:
+            fail(err)
+
+        if self.plan['composer']:
+            # only after the service is up again
+            self.cache_vendor()
+
+        if self.maintenance == 'after':
+            # a failed maintenance does not fail the upgrade, the next run retries it
+            self.borg_maintenance()
+            if self.git_maintenance_enabled:
+                self.git_maintenance()
 
-        step('Start PHP Service')
-        ret = run_cmd('sudo /bin/systemctl start ' + self.php_service)
-        if ret:
-            fail('Failed to start PHP Service')
+        # non-zero return code to signal that we made changes
+        self.success('Done.', 1)
 
-        # load Main page to verify status code and fill caches
-        step('Making test request')
-        time.sleep(3)  # give the server a short time to start
-        req = requests.get(self.check_url)
-        if req.status_code != 200:
-            fail('Check URL returned status code ' + str(req.status_code))
+    def do_minor_upgrade(self):
+        do_upgrade = self.check_minor_upgrade()
+        if not do_upgrade:
+            return
 
-        # non-zero return code to signal that we made changes
-        success('Done.', 1)
+        self.info('Updates available. Proceeding...\n')
+        self.upgrade()
 
     def check_major_upgrade(self):
         self.step('Checking for new version')
@@ -413,7 +1873,8 @@ class MediaWikiUpdater:
         current_version = self.get_current_version()
         self.info('current version', current_version)
 
-        if self.__branch_version(newest_version) <= self.__branch_version(current_version):
+        current = RefIndex.parse_version(current_version) or (-1, -1)
+        if RefIndex.parse_version(newest_version) <= current:
             self.log('up-to-date')
             return False
         return True
@@ -428,112 +1889,67 @@ class MediaWikiUpdater:
             if not do_upgrade:
                 return
 
-        info = self.info
-        step = self.step
-        fail = self.fail
-        success = self.success
-        get_cmd = self.get_cmd
-        run_cmd = self.run_cmd
-
-        info('New version available. Proceeding...\n')
-
-        step('Checking wiki dir')
-        ret = get_cmd('git status --porcelain -uno --ignore-submodules=all')[0]
-        if ret != '':
-            fail('Can not update. Wiki dir has changes! (run git status -uno)')
-
-        step('Stop PHP Service')
-        ret = run_cmd('sudo /bin/systemctl stop ' + self.php_service)
-        if ret:
-            fail('Failed to stop PHP Service')
-
-        step('Backing up Database')
-        ret = self.backup_db()
-        if ret:
-            fail('Database Backup failed')
-
-        step('Backing up Files (with uploads)')
-        ret = self.backup_files_borg()
-        if ret:
-            fail('Files Backup failed')
-
-        ret = self.borg_prune()
-        if ret:
-            fail('Pruning failed')
-
-        step('Checkout new mediawiki branch')
-        new_version = version or self.get_newest_version()
-        upgrade_cmd = 'git pull && git checkout ' + new_version
-        ret = run_cmd(upgrade_cmd)
-        if ret:
-            fail(upgrade_cmd + ' failed!')
-
-        step('Updating Submodules')
-        ret = run_cmd('git submodule update --init --recursive')
-        if ret:
-            # asking nicely didn't work...
-            ret = run_cmd('git submodule update --init --recursive --force')
-        if ret:
-            fail('git submodule update failed')
-
-        step('Updating Extensions (Composer)')
-        ret = run_cmd('https_proxy=' + self.proxy + ' http_proxy=' + self.proxy +
-                      ' composer update --no-dev -o --apcu-autoloader --no-progress --no-suggest -n --no-ansi')
-        if ret:
-            fail('composer update failed')
-
-        step('Updating Extensions (git)')
-        ret = self.update_extensions_git(new_version)
-        if ret:
-            fail('updating extensions failed')
-
-        step('Updating Skins (git)')
-        ret = self.update_skins_git(new_version)
-        if ret:
-            fail('updating skins failed')
-
-        step('Run update.php')
-        ret = run_cmd('php update.php --quick', cwd=self.wiki_dir + 'maintenance/')
-        if ret:
-            fail('update.php failed')
-
-        step('Start PHP Service')
-        ret = run_cmd('sudo /bin/systemctl start ' + self.php_service)
-        if ret:
-            fail('Failed to start PHP Service')
-
-        # load Main page to verify status code and warum up HHVM
-        step('Making test request')
-        time.sleep(3)  # give the server a short time to start HHVM
-        req = requests.get(self.check_url)
-        if req.status_code != 200:
-            fail('Check URL returned status code ' + str(req.status_code))
-
-        # non-zero return code to signal that we made changes
-        success('Done.', 1)
+        self.info('New version available. Proceeding...\n')
+        version = version or self.get_newest_version()
+        self.plan = self.plan_major_upgrade(version)
+        self.upgrade(version)
 
 
 def main(args):
     parser = argparse.ArgumentParser()
     parser.add_argument(
         '--simple', help='use simple output for non-terminal', action='store_true')
+    parser.add_argument(
+        '--refresh', help='ignore cached remote refs', action='store_true')
     parser.add_argument(
         '--major', help='perform a major version upgrade', action='store_true')
     parser.add_argument(
         '-v', '--version', help='update to this version, only supported for major updates', type=str, default=None)
+    parser.add_argument(
+        '--restore-db', help='also restore the database dump when rolling back', action='store_true')
+    parser.add_argument(
+        '--force-update-php', help='run update.php even if no schema changes were pulled', action='store_true')
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument(
+        '--plan', help='only check for updates and save the planned actions', action='store_true')
+    mode.add_argument(
+        '--apply', help='perform the actions saved by --plan without checking again', action='store_true')
+    mode.add_argument(
+        '--rollback', help='roll back the last upgrade', action='store_true')
+    mode.add_argument(
+        '--maintenance', help='only run the maintenance of the borg and git repositories', action='store_true')
     args = parser.parse_args()
 
-    updater = MediaWikiUpdater(out_simple=args.simple)
-
-    if args.major:
-        updater.do_major_upgrade(version=args.version)
-        return
+    updater = MediaWikiUpdater(out_simple=args.simple, refresh=args.refresh, force_update_php=args.force_update_php,
+                               restore_db=args.restore_db)
 
     ret = 0
-    if updater.check_major_upgrade():
-        print('new major version available!')
-        ret = 2
-    updater.do_minor_upgrade()
+    try:
+        if args.rollback:
+            updater.do_rollback()
+        elif args.maintenance:
+            updater.use_maintenance_report()
+            if updater.borg_maintenance(wait=False):
+                updater.fail('Borg maintenance failed')
+            if updater.git_maintenance_enabled and updater.git_maintenance():
+                updater.fail('Git maintenance failed')
+        elif args.plan:
+            ret = updater.write_plan(major=args.major, version=args.version)
+        elif args.apply:
+            updater.apply_plan()
+        elif args.major:
+            updater.do_major_upgrade(version=args.version)
+        else:
+            if updater.check_major_upgrade():
+                print('new major version available!')
+                ret = 2
+            updater.do_minor_upgrade()
+    except SystemExit as ex:
+        ret = ex.code
+    except BaseException:
+        updater.write_report(-1)
+        raise
+    updater.write_report(ret)
     sys.exit(ret)
 
 
@@ -0,0 +1,249 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Offline benchmark of the upgrade pipeline
+
+Builds a fake wiki in a temporary directory: bare "origin" repositories for
+core, N extensions and a skin (REL branches and release tags, every extension
+with a submodule), local clones of them as wiki tree and stubs for mysqldump,
+mysql, borg, composer, php and systemctl. Then the wall-clock time of
+check_minor_upgrade, check_major_upgrade, do_minor_upgrade and
+do_major_upgrade is measured for each N. Nothing outside of the temporary
+directory is touched.
+
+    ./upgrade_bench.py --sizes 1,10,50 --repeat 3 --json bench.json
+"""
+
+import sys
+import os
+import argparse
+import contextlib
+import functools
+import http.server
+import io
+import json
+import shutil
+import statistics
+import subprocess
+import tempfile
+import threading
+import time
+
+import upgrade
+
+BRANCHES = ['REL1_38', 'REL1_39', 'REL1_40']
+TAGS = {'1.38.0': 'REL1_38', '1.39.0': 'REL1_39'}
+
+STUBS = {
+    'mysqldump': 'echo "-- dump of $*"',
+    'mysql': 'case "$*" in *CHECKSUM*) printf "wiki.page\\t1\\n";; *) printf "page\\t2022-01-01 00:00:00\\n";; esac',
+    'borg': 'cat >/dev/null; [ "$1" = create ] && echo \'{"archive": {"duration": 0, '
+            '"stats": {"original_size": 0, "deduplicated_size": 0}}}\'; exit 0',
+    'composer': 'mkdir -p vendor && echo "<?php" > vendor/autoload.php && touch composer.lock',
+    'php': 'exit 0',
+    'systemctl': 'exit 0',
+}
+
+
+class Fixture:
+    """Fixture is a fake wiki with local origins for core and n_extensions extensions"""
+
+    def __init__(self, root, n_extensions):
+        self.root = root
+        self.extensions = ['Ext' + str(i) for i in range(n_extensions)]
+        self.skins = ['Skin0']
+        self.wiki_dir = root + '/wiki/'
+        self.server = None
+
+    def git(self, args, cwd):
+        subprocess.run(['git', '-c', 'user.name=bench', '-c', 'user.email=bench@localhost'] + args,
+                       cwd=cwd, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def commit(self, src, msg):
+        with open(src + '/README', 'a', encoding='utf-8') as f:
+            f.write(msg + '\n')
+        self.git(['commit', '-qam', msg], src)
+
+    def make_repo(self, name, submodule=None):
+        """creates src/name with master, REL branches and tags and its bare clone origin/name.git"""
+        src = self.root + '/src/' + name
+        os.makedirs(src)
+        self.git(['init', '-q', '.'], src)
+        self.git(['checkout', '-q', '-b', 'master'], src)
+        with open(src + '/README', 'w', encoding='utf-8') as f:
+            f.write(name + '\n')
+        self.git(['add', 'README'], src)
+        if submodule:
+            self.git(['submodule', '-q', 'add', self.root + '/origin/' + submodule + '.git', 'lib'], src)
+        self.git(['commit', '-qm', 'initial commit'], src)
+        for branch in BRANCHES:
+            self.git(['branch', branch], src)
+        for tag, branch in TAGS.items():
+            self.git(['tag', tag, branch], src)
+        self.git(['clone', '-q', '--bare', src, self.root + '/origin/' + name + '.git'], self.root)
+
+    def build(self):
+        os.makedirs(self.root + '/origin')
+        self.make_repo('lib')
+        self.make_repo('core')
+        self.git(['clone', '-q', '-b', 'REL1_38', self.root + '/origin/core.git', self.wiki_dir], self.root)
+        with open(self.wiki_dir + '.git/info/exclude', 'a', encoding='utf-8') as f:
+            f.write('extensions/\nskins/\nmaintenance/\n')
+        for kind, names in (('extensions', self.extensions), ('skins', self.skins)):
+            for name in names:
+                self.make_repo(name, submodule='lib' if kind == 'extensions' else None)
+                self.git(['clone', '-q', '--recurse-submodules', '-b', 'REL1_38',
+                          self.root + '/origin/' + name + '.git', self.wiki_dir + kind + '/' + name], self.root)
+        os.makedirs(self.wiki_dir + 'maintenance')
+
+        os.makedirs(self.root + '/stubs')
+        for name, body in STUBS.items():
+            path = self.root + '/stubs/' + name
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write('#!/bin/sh\n' + body + '\n')
+            os.chmod(path, 0o700)
+
+        for name in ('dump', 'state'):
+            os.makedirs(self.root + '/' + name)
+        with open(self.root + '/upgrade.ini', 'w', encoding='utf-8') as f:
+            f.write(f"""[env]
+proxy=
+php_service=php-fpm.service
+service_cmd={self.root}/stubs/systemctl
+composer_home={self.root}/composer
+state_dir={self.root}/state/
+prometheus_file=
+
+[wiki]
+dir={self.wiki_dir}
+extensions_git={','.join(self.extensions)}
+skins_git={','.join(self.skins)}
+check_url=http://127.0.0.1:{self.serve()}/index.html
+
+[backup]
+db_dump_dir={self.root}/dump/
+borg_base={self.root}/borg_base
+borg_dir={self.root}/borg_repo
+db_name=wiki
+db_user=wiki
+db_pass=wiki
+""")
+
+    def serve(self):
+        """serves the wiki dir, so the test request of the upgrade succeeds"""
+        with open(self.wiki_dir + 'index.html', 'w', encoding='utf-8') as f:
+            f.write('<html></html>\n')
+        with open(self.wiki_dir + '.git/info/exclude', 'a', encoding='utf-8') as f:
+            f.write('index.html\n')
+
+        class Handler(http.server.SimpleHTTPRequestHandler):
+            def log_message(self, *args):  # pylint: disable=arguments-differ
+                pass
+        handler = functools.partial(Handler, directory=self.wiki_dir)
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self.server.server_address[1]
+
+    def bump(self, branch='REL1_38'):
+        """pushes a new commit to branch of core and every extension and skin"""
+        for name in ['core'] + self.extensions + self.skins:
+            src = self.root + '/src/' + name
+            self.git(['checkout', '-q', branch], src)
+            self.commit(src, 'bump ' + branch)
+            self.git(['push', '-q', self.root + '/origin/' + name + '.git', branch], src)
+
+    def close(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+
+
+def measure(fixture, verbose=False):
+    """runs the upgrade paths once against fixture and returns {name: seconds}"""
+    def updater():
+        return upgrade.MediaWikiUpdater(out_simple=True, config_file=fixture.root + '/upgrade.ini')
+
+    def timed(name, func):
+        out = io.StringIO()
+        start = time.monotonic()
+        code = 0
+        with contextlib.redirect_stdout(sys.stdout if verbose else out):
+            try:
+                func()
+            except SystemExit as ex:
+                code = ex.code
+        duration = time.monotonic() - start
+        # success() exits with 1 after an upgrade
+        if code not in (None, 0, 1):
+            print(out.getvalue())
+            raise RuntimeError(name + ' exited with ' + str(code))
+        return duration
+
+    fixture.bump()
+    result = {}
+    for name in ('check_minor_upgrade', 'check_major_upgrade', 'do_minor_upgrade'):
+        result[name] = timed(name, getattr(updater(), name))
+    major = updater()
+    result['do_major_upgrade'] = timed('do_major_upgrade', lambda: major.do_major_upgrade(version='REL1_39'))
+    return result
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description='benchmark the upgrade pipeline against a local fake wiki')
+    parser.add_argument(
+        '--sizes', help='comma separated numbers of extensions', type=str, default='1,5,10,20')
+    parser.add_argument(
+        '--repeat', help='runs per size, the median is reported', type=int, default=3)
+    parser.add_argument(
+        '--json', help='also write the results to this file', type=str, default=None)
+    parser.add_argument(
+        '--keep', help='keep the fixtures (printed paths)', action='store_true')
+    parser.add_argument(
+        '-v', '--verbose', help='show the output of the updater', action='store_true')
+    args = parser.parse_args(args[1:])
+
+    sizes = [int(size) for size in args.sizes.split(',')]
+    root = tempfile.mkdtemp(prefix='upgrade_bench_')
+    # the submodules are cloned from local paths
+    os.environ.update(GIT_CONFIG_COUNT='1', GIT_CONFIG_KEY_0='protocol.file.allow', GIT_CONFIG_VALUE_0='always')
+    path = os.environ['PATH']
+
+    results = {}
+    try:
+        for size in sizes:
+            runs = []
+            for i in range(args.repeat):
+                fixture = Fixture(f'{root}/{size}-{i}', size)
+                try:
+                    fixture.build()
+                    # the stubs shadow the real tools
+                    os.environ['PATH'] = fixture.root + '/stubs:' + path
+                    runs.append(measure(fixture, args.verbose))
+                finally:
+                    os.environ['PATH'] = path
+                    fixture.close()
+                if not args.keep:
+                    shutil.rmtree(fixture.root)
+            results[size] = {name: statistics.median(run[name] for run in runs) for name in runs[0]}
+    finally:
+        if args.keep:
+            print('fixtures kept in ' + root)
+        else:
+            shutil.rmtree(root, ignore_errors=True)
+
+    names = list(next(iter(results.values())))
+    rows = [['EXTENSIONS'] + names]
+    rows += [[str(size)] + [f'{result[name]:.3f}' for name in names] for size, result in results.items()]
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    for row in rows:
+        print('  '.join(cell.ljust(widths[i]) for i, cell in enumerate(row)).rstrip())
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({'repeat': args.repeat, 'seconds': results}, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
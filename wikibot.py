@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+
+"""
+Shared runtime of the wiki bots (announce.py, mensa.py, sss.py)
+
+Reads the <script>.ini next to the script, connects to the wiki and logs in
+only when the site is needed and imports heavy libraries on first use. With
+--profile-startup the time spent per phase (config, imports, connection,
+login) is reported on stderr.
+
+Sources are fetched with conditional requests and pages are only saved if
+their text changed; both are remembered in state_dir/<script>.json.
+"""
+
+import argparse
+import configparser
+import contextlib
+import hashlib
+import importlib
+import json
+import os
+import sys
+import time
+import urllib.error
+import urllib.request
+
+
+class Profile:
+    """Profile records the duration of named phases"""
+
+    def __init__(self):
+        self.enabled = False
+        self.start = time.perf_counter()
+        self.phases = []
+        self.reported = 0
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if self.enabled:
+                self.phases.append((name, time.perf_counter() - start))
+
+    def report(self):
+        """prints the phases recorded since the last report"""
+        if not self.enabled:
+            return
+        for name, duration in self.phases[self.reported:]:
+            print(f'{name:<32} {duration * 1000:8.1f} ms', file=sys.stderr)
+        self.reported = len(self.phases)
+        print(f'{"total since wikibot import":<32} {(time.perf_counter() - self.start) * 1000:8.1f} ms',
+              file=sys.stderr)
+
+
+PROFILE = Profile()
+
+
+def lazy_import(name):
+    """imports the module name on first use, so scripts only pay for the features they use"""
+    module = sys.modules.get(name)
+    if module is not None:
+        return module
+    with PROFILE.phase('import ' + name):
+        return importlib.import_module(name)
+
+
+def argument_parser(description):
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument(
+        '--profile-startup', help='report the time spent importing and connecting per phase', action='store_true')
+    return parser
+
+
+class Bot:
+    """Bot holds the configuration and the wiki connection of one bot run"""
+
+    def __init__(self, script, args):
+        PROFILE.enabled = args.profile_startup
+        with PROFILE.phase('config'):
+            self.config = configparser.RawConfigParser()
+            # next to the script, independent of the working directory
+            self.config.read(os.path.splitext(os.path.realpath(script))[0] + '.ini')
+        self._site = None
+        self.name = os.path.splitext(os.path.basename(script))[0]
+        self.state_dir = self.config.get('env', 'state_dir', fallback='/var/cache/wiki-scripts/')
+        self.cache_file = self.state_dir + self.name + '.json'
+        self._cache = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        PROFILE.report()
+
+    def site(self):
+        """returns the mwclient site of [mwclient], logged in if a user is configured"""
+        if self._site is None:
+            cfg = self.config.get
+            mwclient = lazy_import('mwclient')
+            with PROFILE.phase('connect'):
+                site = mwclient.Site(cfg('mwclient', 'site', fallback='wiki.stusta.de'),
+                                     path=cfg('mwclient', 'path', fallback='/'))
+            if self.config.has_option('mwclient', 'user'):
+                with PROFILE.phase('login'):
+                    site.login(cfg('mwclient', 'user'), cfg('mwclient', 'pass'))
+            self._site = site
+        return self._site
+
+    @property
+    def cache(self):
+        """{'urls': {url: validators}, 'pages': {title: sha256 of the saved text}}"""
+        if self._cache is None:
+            try:
+                with open(self.cache_file, encoding='utf-8') as f:
+                    self._cache = json.load(f)
+            except (OSError, ValueError):
+                self._cache = {}
+            self._cache.setdefault('urls', {})
+            self._cache.setdefault('pages', {})
+        return self._cache
+
+    def save_cache(self):
+        os.makedirs(self.state_dir, exist_ok=True)
+        with open(self.cache_file + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(self.cache, f, indent=2)
+        os.replace(self.cache_file + '.tmp', self.cache_file)
+
+    def fetch(self, url, opener=None):
+        """returns the body of url
+
+        The request is conditional (ETag/Last-Modified of the last response), if the source did not change the
+        body of the last response is returned from the cache.
+        """
+        opener = opener or urllib.request.build_opener()
+        body_file = f'{self.state_dir}{self.name}-{hashlib.sha256(url.encode("utf-8")).hexdigest()[:16]}.body'
+        validators = self.cache['urls'].get(url, {}) if os.path.exists(body_file) else {}
+        headers = {}
+        if validators.get('etag'):
+            headers['If-None-Match'] = validators['etag']
+        if validators.get('last_modified'):
+            headers['If-Modified-Since'] = validators['last_modified']
+        try:
+            with opener.open(urllib.request.Request(url, headers=headers)) as response:
+                body = response.read()
+                etag = response.headers.get('ETag')
+                last_modified = response.headers.get('Last-Modified')
+        except urllib.error.HTTPError as ex:
+            if ex.code != 304:
+                raise
+            with open(body_file, 'rb') as f:
+                return f.read()
+
+        if etag or last_modified:
+            os.makedirs(self.state_dir, exist_ok=True)
+            with open(body_file, 'wb') as f:
+                f.write(body)
+            self.cache['urls'][url] = {'etag': etag, 'last_modified': last_modified}
+        else:
+            self.cache['urls'].pop(url, None)
+        self.save_cache()
+        return body
+
+    def save_page(self, title, text, summary):
+        """saves text to the page title unless it already has this text, returns whether it was saved"""
+        digest = hashlib.sha256(text.encode('utf-8')).hexdigest()
+        # saved by the last run, no need to ask the wiki
+        if self.cache['pages'].get(title) == digest:
+            print(f'{title}: unchanged')
+            return False
+        page = self.site().Pages[title]
+        # mediawiki strips trailing whitespace on save
+        saved = page.text().rstrip() != text.rstrip()
+        if saved:
+            page.save(text, summary=summary)
+        else:
+            print(f'{title}: unchanged')
+        self.cache['pages'][title] = digest
+        self.save_cache()
+        return saved